@@ -0,0 +1,507 @@
+import bisect
+import gzip
+import os
+import re
+import shutil
+import time
+
+from twisted.internet import defer, reactor, threads, utils
+from twisted.python import log
+
+from buildbot.process.buildstep import BuildStep
+from buildbot.status.results import SUCCESS, FAILURE
+
+## @brief The 'building' APT repository, as used by reprepro-include.bash
+REPO_DIR = '/var/www/building/ubuntu'
+
+## @brief Raised when a reprepro command of a transaction fails
+class AptTransactionError(Exception):
+    def __init__(self, msg, output):
+        Exception.__init__(self, msg)
+        self.output = output
+
+## @brief Run reprepro against the repository
+## @returns A deferred firing with (stdout, stderr, return code)
+def reprepro(args, repo_dir = REPO_DIR):
+    return utils.getProcessOutputAndValue('reprepro', ['-V', '-b', repo_dir] + args, env = os.environ)
+
+## @brief Reverse dependency index of one distro and arch of the repository. Finds the
+##        same packages as the removefilter in reprepro-include.bash, which matches
+##        'Depends (% *PKG[, ]* ) | Depends (% *PKG )': some token of the Depends field,
+##        split on commas and spaces, ends with the package name.
+class DependentsIndex:
+
+    def __init__(self):
+        self.depends = dict()  # package -> set of tokens in its Depends
+        self.tokens = dict()   # token -> set of packages with it in their Depends
+        self.suffixes = list() # sorted reversed tokens, so suffix matches are a range
+
+    def __contains__(self, package):
+        return package in self.depends
+
+    def __len__(self):
+        return len(self.depends)
+
+    ## @brief Add or replace a package
+    ## @param depends The Depends field of the package
+    def add(self, package, depends):
+        self.remove(package)
+        tokens = set([t for t in re.split('[, ]', depends) if t])
+        self.depends[package] = tokens
+        for token in tokens:
+            if token not in self.tokens:
+                self.tokens[token] = set()
+                bisect.insort(self.suffixes, token[::-1])
+            self.tokens[token].add(package)
+
+    def remove(self, package):
+        for token in self.depends.pop(package, set()):
+            self.tokens[token].discard(package)
+            if not self.tokens[token]:
+                del self.tokens[token]
+                del self.suffixes[bisect.bisect_left(self.suffixes, token[::-1])]
+
+    ## @brief Get the packages which directly depend on a package
+    def dependents(self, package):
+        found = set()
+        key = package[::-1]
+        i = bisect.bisect_left(self.suffixes, key)
+        while i < len(self.suffixes) and self.suffixes[i].startswith(key):
+            found |= self.tokens[self.suffixes[i][::-1]]
+            i += 1
+        return found
+
+## @brief Master side service which owns the 'building' APT repository. Include requests
+##        from all builders are queued, and merged into one transaction per distro and arch.
+##        Each transaction invalidates the dependents of all its packages, includes all of
+##        the debs, and only then exports the indices once. Debs which can not be read or
+##        are rejected by reprepro only fail their own request. Transactions are serialized, as
+##        reprepro holds a lock on the whole repository anyways. Dependents are found with a
+##        DependentsIndex per distro and arch, so only affected packages are touched, rather
+##        than scanning every package with a removefilter.
+##
+##        Clients do not read the dists reprepro writes to, since they could see half of an
+##        export. After each transaction, the indices are hardlinked into an immutable
+##        snapshots/<serial> directory (sharing the pool through a symlink), and the 'current'
+##        symlink is atomically switched to it. Files dropped from the pool are kept until no
+##        retained snapshot references them.
+class AptRepository:
+
+    ## @brief Constructor
+    ## @param repo_dir The reprepro base directory
+    ## @param delay Seconds to wait for more requests before starting a transaction
+    ## @param keep Number of snapshots to keep around for rollback
+    def __init__(self, repo_dir = REPO_DIR, delay = 5, keep = 5):
+        self.repo_dir = repo_dir
+        self.delay = delay
+        self.keep = max(1, keep)
+        self.queues = dict()   # (distro, arch) -> list of requests
+        self.pending = dict()  # (distro, arch) -> delayed call starting a transaction
+        self.lock = defer.DeferredLock()
+        self.indexes = dict()  # (distro, arch) -> DependentsIndex
+        self.db_stamp = None   # mtime of the reprepro database after our last change
+
+    ## @brief Number of include requests waiting for a transaction
+    def depth(self):
+        return sum([len(q) for q in self.queues.values()])
+
+    ## @brief Queue a deb to be included
+    ## @param package Debian package name (for instance, 'ros-groovy-foo')
+    ## @param deb Absolute path to the .deb file
+    ## @param distro Ubuntu distro (for instance, 'precise')
+    ## @param arch Architecture of the deb (for instance, 'amd64')
+    ## @returns A deferred firing with a dictionary describing the transaction, once
+    ##          the deb is published
+    def include(self, package, deb, distro, arch):
+        key = (distro, arch)
+        d = defer.Deferred()
+        self.queues.setdefault(key, list()).append({'package': package, 'deb': deb,
+                                                    'queued': time.time(), 'deferred': d})
+        log.msg('apt_repo: queued %s for %s/%s, %d requests queued' % (package, distro, arch, self.depth()))
+        if key not in self.pending:
+            self.pending[key] = reactor.callLater(self.delay, self._flush, key)
+        return d
+
+    def _flush(self, key):
+        del self.pending[key]
+        d = self.lock.run(self._transaction, key)
+        d.addErrback(log.err, 'while running apt transaction for %s/%s' % key)
+
+    @defer.inlineCallbacks
+    def _transaction(self, key):
+        # take everything queued by now, including what arrived while waiting for the lock
+        requests = self.queues.pop(key, list())
+        if not requests:
+            return
+        distro, arch = key
+        log.msg('apt_repo: transaction of %d debs for %s/%s' % (len(requests), distro, arch))
+        start = time.time()
+        output = list()
+        try:
+            # a broken deb only fails its own build, and nothing is removed on its behalf
+            requests = yield self._check(requests)
+            if not requests:
+                return
+            packages = sorted(set([r['package'] for r in requests]))
+            index = yield self._index(distro, arch)
+            affected = set(packages)
+            for pkg in packages:
+                affected |= index.dependents(pkg)
+            # only remove what is there, reprepro complains about the rest
+            present = sorted([pkg for pkg in affected if pkg in index])
+            log.msg('apt_repo: invalidating %d of %d packages in %s/%s' % (len(present), len(index), distro, arch))
+            if present:
+                yield self._run(output, ['--export=never', '--keepunreferencedfiles',
+                                         '-A', arch, 'remove', distro] + present)
+                for pkg in present:
+                    index.remove(pkg)
+            try:
+                yield self._run(output, ['--export=never', '--keepunreferencedfiles',
+                                         'includedeb', distro] + [r['deb'] for r in requests])
+            except AptTransactionError:
+                # include the debs one by one, so that only those reprepro rejects fail
+                log.msg('apt_repo: including %d debs for %s/%s one at a time' % (len(requests), distro, arch))
+                requests = yield self._include_each(output, distro, requests)
+            yield self._load(index, distro, arch, ' | '.join(['Package (==%s)' % pkg for pkg in packages]))
+            yield self._run(output, ['export', distro])
+            serial = yield threads.deferToThread(self._snapshot)
+            output.append('Published snapshot %d' % serial)
+        except Exception as e:
+            log.msg('apt_repo: transaction for %s/%s failed after %.1fs: %s' % (distro, arch, time.time()-start, e))
+            # we no longer know what is in the repository, reload the index next time
+            self.indexes.pop(key, None)
+            for r in requests:
+                if not r['deferred'].called:
+                    r['deferred'].errback(e)
+            return
+        finally:
+            self.db_stamp = self._db_mtime()
+        elapsed = time.time() - start
+        log.msg('apt_repo: transaction for %s/%s took %.1fs, %d requests still queued' % (distro, arch, elapsed, self.depth()))
+        for r in requests:
+            r['deferred'].callback({'batch': len(requests), 'elapsed': elapsed,
+                                    'waited': start - r['queued'], 'output': '\n'.join(output)})
+        # builds are not waiting on this, and a failure here only leaves some extra files
+        try:
+            yield self._prune()
+        except Exception:
+            log.err(None, 'while pruning apt snapshots')
+
+    ## @brief Fail the requests whose deb can not be read
+    ## @returns A deferred firing with the remaining requests
+    @defer.inlineCallbacks
+    def _check(self, requests):
+        good = list()
+        for r in requests:
+            out, err, code = yield utils.getProcessOutputAndValue('dpkg-deb', ['--field', r['deb'], 'Package'],
+                                                                  env = os.environ)
+            if code == 0:
+                good.append(r)
+                continue
+            log.msg('apt_repo: not including %s, %s is not a valid deb' % (r['package'], r['deb']))
+            r['deferred'].errback(AptTransactionError('dpkg-deb --field %s returned %d' % (r['deb'], code),
+                                                      '$ dpkg-deb --field %s Package\n%s%s' % (r['deb'], out, err)))
+        defer.returnValue(good)
+
+    ## @brief Include the debs of some requests one at a time, failing those reprepro rejects
+    ## @returns A deferred firing with the requests which were included
+    @defer.inlineCallbacks
+    def _include_each(self, output, distro, requests):
+        included = list()
+        for r in requests:
+            deb_output = list()
+            try:
+                yield self._run(deb_output, ['--export=never', '--keepunreferencedfiles',
+                                             'includedeb', distro, r['deb']])
+            except AptTransactionError as e:
+                log.msg('apt_repo: failed to include %s: %s' % (r['package'], e))
+                r['deferred'].errback(AptTransactionError(str(e), '\n'.join(output + deb_output)))
+                continue
+            output.extend(deb_output)
+            included.append(r)
+        defer.returnValue(included)
+
+    ## @brief Get the serials of the snapshots, oldest first
+    def _serials(self):
+        snapshots = os.path.join(self.repo_dir, 'snapshots')
+        if not os.path.isdir(snapshots):
+            return list()
+        return sorted([int(name) for name in os.listdir(snapshots) if name.isdigit()])
+
+    ## @brief Hardlink the exported indices into a new snapshot, and make it current.
+    ##        reprepro replaces index files with a rename when exporting, so the
+    ##        hardlinked files in a snapshot never change.
+    ## @returns The serial of the new snapshot
+    def _snapshot(self):
+        serials = self._serials()
+        serial = serials[-1] + 1 if serials else 0
+        snapshots = os.path.join(self.repo_dir, 'snapshots')
+        tmp = os.path.join(snapshots, '.%d' % serial)
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        dists = os.path.join(self.repo_dir, 'dists')
+        for root, dirs, files in os.walk(dists):
+            target = os.path.join(tmp, 'dists', os.path.relpath(root, dists))
+            os.makedirs(target)
+            for name in files:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+        os.symlink(os.path.join('..', '..', 'pool'), os.path.join(tmp, 'pool'))
+        os.rename(tmp, os.path.join(snapshots, str(serial)))
+        self._switch(serial)
+        return serial
+
+    ## @brief Atomically point the 'current' symlink at a snapshot
+    def _switch(self, serial):
+        current = os.path.join(self.repo_dir, 'current')
+        if os.path.lexists(current+'.new'):
+            os.remove(current+'.new')
+        os.symlink(os.path.join('snapshots', str(serial)), current+'.new')
+        os.rename(current+'.new', current)
+        log.msg('apt_repo: published snapshot %d' % serial)
+
+    ## @brief Point clients at an older snapshot. The reprepro database is not changed,
+    ##        so the next transaction publishes the database again.
+    ## @param serial The snapshot to publish, defaults to the one before the current
+    def rollback(self, serial = None):
+        return self.lock.run(threads.deferToThread, self._rollback, serial)
+
+    def _rollback(self, serial):
+        serials = self._serials()
+        current = int(os.path.basename(os.readlink(os.path.join(self.repo_dir, 'current'))))
+        if serial == None:
+            older = [s for s in serials if s < current]
+            if not older:
+                raise ValueError('no snapshot older than %d' % current)
+            serial = older[-1]
+        if serial not in serials:
+            raise ValueError('no snapshot %d' % serial)
+        self._switch(serial)
+        return serial
+
+    ## @brief Remove all but the newest snapshots, and then the files in the pool which
+    ##        neither reprepro nor any remaining snapshot reference
+    @defer.inlineCallbacks
+    def _prune(self):
+        removed = yield threads.deferToThread(self._remove_snapshots)
+        if not removed:
+            return
+        out, err, code = yield reprepro(['dumpunreferenced'], self.repo_dir)
+        if code != 0:
+            log.msg('apt_repo: dumpunreferenced failed: %s' % err.strip())
+            return
+        unreferenced = [line.strip() for line in out.splitlines() if line.strip()]
+        if not unreferenced:
+            return
+        referenced = yield threads.deferToThread(self.referenced_files)
+        delete = [f for f in unreferenced if f not in referenced]
+        log.msg('apt_repo: %d unreferenced files, %d still in snapshots' % (len(unreferenced), len(unreferenced)-len(delete)))
+        if delete:
+            out, err, code = yield reprepro(['deleteifunreferenced'] + delete, self.repo_dir)
+            if code != 0:
+                log.msg('apt_repo: deleteifunreferenced failed: %s' % err.strip())
+
+    ## @brief Remove the oldest snapshots, never the current one
+    ## @returns The number of snapshots removed
+    def _remove_snapshots(self):
+        serials = self._serials()
+        current = os.path.basename(os.readlink(os.path.join(self.repo_dir, 'current')))
+        removed = 0
+        for serial in serials[:-self.keep]:
+            if str(serial) == current:
+                continue
+            shutil.rmtree(os.path.join(self.repo_dir, 'snapshots', str(serial)))
+            removed += 1
+        return removed
+
+    ## @brief Get the pool files referenced by the Packages files of all snapshots
+    def referenced_files(self):
+        files = set()
+        for serial in self._serials():
+            for root, dirs, names in os.walk(os.path.join(self.repo_dir, 'snapshots', str(serial), 'dists')):
+                if 'Packages' in names:
+                    f = open(os.path.join(root, 'Packages'))
+                elif 'Packages.gz' in names:
+                    f = gzip.open(os.path.join(root, 'Packages.gz'))
+                else:
+                    continue
+                for line in f:
+                    if line.startswith('Filename:'):
+                        files.add(line.split(':', 1)[1].strip())
+                f.close()
+        return files
+
+    ## @brief Get the DependentsIndex of a distro and arch, loading it from reprepro if needed.
+    ##        If the repository was changed behind our back (for instance by running
+    ##        reprepro-include.bash by hand) all of the indexes are reloaded.
+    @defer.inlineCallbacks
+    def _index(self, distro, arch):
+        if self.db_stamp != self._db_mtime():
+            self.indexes = dict()
+        key = (distro, arch)
+        if key not in self.indexes:
+            index = DependentsIndex()
+            yield self._load(index, distro, arch, 'Package (% *)')
+            log.msg('apt_repo: indexed %d packages in %s/%s' % (len(index), distro, arch))
+            self.indexes[key] = index
+        defer.returnValue(self.indexes[key])
+
+    ## @brief Add the packages matching a reprepro formula to an index
+    @defer.inlineCallbacks
+    def _load(self, index, distro, arch, formula):
+        out, err, code = yield reprepro(['-A', arch, '--list-format', '${Package}\t${Depends}\n',
+                                         'listfilter', distro, formula], self.repo_dir)
+        if code != 0:
+            raise AptTransactionError('reprepro listfilter returned %d' % code, err)
+        for line in out.splitlines():
+            if '\t' in line:
+                package, depends = line.split('\t', 1)
+                index.add(package, depends)
+
+    def _db_mtime(self):
+        try:
+            return os.path.getmtime(os.path.join(self.repo_dir, 'db', 'packages.db'))
+        except OSError:
+            return None
+
+    @defer.inlineCallbacks
+    def _run(self, output, args):
+        out, err, code = yield reprepro(args, self.repo_dir)
+        output.append('$ reprepro %s\n%s%s' % (' '.join(args), out, err))
+        if code != 0:
+            raise AptTransactionError('reprepro %s returned %d' % (' '.join(args), code), '\n'.join(output))
+
+_repository = None
+
+## @brief Get the AptRepository shared by all builders. This survives a reconfig, since
+##        modules are not reloaded.
+def get_repository():
+    global _repository
+    if _repository == None:
+        _repository = AptRepository()
+    return _repository
+
+## @brief Get the versions of a package in the APT repository, per architecture
+## @param package Debian package name (for instance, 'ros-groovy-foo')
+## @param distro Ubuntu distro (for instance, 'precise')
+## @param arch Architecture to look for, or None for all
+## @returns A deferred firing with a dictionary of arch -> version
+@defer.inlineCallbacks
+def published_versions(package, distro, arch = None, repo_dir = REPO_DIR):
+    args = ['-b', repo_dir]
+    if arch:
+        args += ['-A', arch]
+    args += ['list', distro, package]
+    out, err, code = yield utils.getProcessOutputAndValue('reprepro', args, env = os.environ)
+    versions = dict()
+    if code != 0:
+        log.msg('apt_repo: reprepro list %s %s failed: %s' % (distro, package, err.strip()))
+        defer.returnValue(versions)
+    # lines look like 'precise|main|amd64: ros-groovy-foo 0.1.0-0-20140101-1200-+0000precise'
+    for line in out.splitlines():
+        try:
+            where, what = line.split(': ', 1)
+            name, version = what.split()
+        except ValueError:
+            continue
+        if name == package:
+            versions[where.split('|')[-1]] = version
+    defer.returnValue(versions)
+
+## @brief Master side step checking whether a release version of some packages is already
+##        published for all architectures. The result is stored in the 'deb_skip' property,
+##        later steps can use deb_needed as their doStepIf. A package still being in the
+##        repository also means nothing it depends on was re-included since, as
+##        reprepro-include.bash removes all dependents of a package when including it.
+class CheckPublished(BuildStep):
+
+    name = 'check-published'
+    description = ['checking', 'apt']
+    descriptionDone = ['checked', 'apt']
+    renderables = ['version']
+
+    ## @brief Constructor
+    ## @param packages List of debian package names
+    ## @param version Release version (for instance, '0.8.1-0'), may be renderable
+    ## @param distro Ubuntu distro (for instance, 'precise')
+    ## @param arches List of architectures which must all have the version
+    def __init__(self, packages, version, distro, arches, repo_dir = REPO_DIR, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.packages = packages
+        self.version = version
+        self.distro = distro
+        self.arches = arches
+        self.repo_dir = repo_dir
+
+    def start(self):
+        d = self._check()
+        d.addCallback(self._finished)
+        d.addErrback(self.failed)
+
+    @defer.inlineCallbacks
+    def _check(self):
+        # the stamped version is '<release_version>-<datestamp><distro>'
+        prefix = self.version+'-'
+        missing = list()
+        for package in self.packages:
+            arch = self.arches[0] if len(self.arches) == 1 else None
+            versions = yield published_versions(package, self.distro, arch, self.repo_dir)
+            for arch in self.arches:
+                version = versions.get(arch)
+                if version == None or not version.startswith(prefix) or not version.endswith(self.distro):
+                    missing.append('%s (%s): %s' % (package, arch, version))
+        defer.returnValue(missing)
+
+    def _finished(self, missing):
+        skip = len(missing) == 0
+        self.setProperty('deb_skip', skip, 'CheckPublished')
+        if skip:
+            self.addCompleteLog('published', '%s is already published\n' % self.version)
+            self.descriptionDone = ['already', 'published']
+        else:
+            self.addCompleteLog('published', 'Not published at %s:\n  %s\n' % (self.version, '\n  '.join(missing)))
+            self.descriptionDone = ['needs', 'build']
+        self.step_status.setText(self.descriptionDone)
+        self.finished(SUCCESS)
+
+## @brief doStepIf for steps which are not needed when CheckPublished found the build published
+def deb_needed(step):
+    return not step.build.getProperty('deb_skip', False)
+
+## @brief Master side step including a binary deb uploaded to binarydebs/ into the
+##        APT repository, through the shared AptRepository
+class AptInclude(BuildStep):
+
+    description = ['including', 'apt']
+    renderables = ['deb']
+
+    ## @brief Constructor
+    ## @param package Debian package name (for instance, 'ros-groovy-foo')
+    ## @param deb File name of the deb in binarydebs/, may be renderable
+    ## @param distro Ubuntu distro (for instance, 'precise')
+    ## @param arch Architecture of the deb (for instance, 'amd64')
+    def __init__(self, package, deb, distro, arch, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.package = package
+        self.deb = deb
+        self.distro = distro
+        self.arch = arch
+
+    def start(self):
+        repo = get_repository()
+        self.step_status.setText(['queued', 'apt', '(%d ahead)' % repo.depth()])
+        d = repo.include(self.package, os.path.abspath(os.path.join('binarydebs', self.deb)),
+                         self.distro, self.arch)
+        d.addCallbacks(self._included, self._failed)
+        d.addErrback(self.failed)
+
+    def _included(self, result):
+        self.addCompleteLog('reprepro', result['output'])
+        self.addCompleteLog('transaction', 'waited %.1fs, transaction of %d debs took %.1fs\n' %
+                            (result['waited'], result['batch'], result['elapsed']))
+        self.step_status.setText(['updated in apt', self.deb])
+        self.finished(SUCCESS)
+
+    def _failed(self, failure):
+        self.addCompleteLog('reprepro', getattr(failure.value, 'output', str(failure.value)))
+        self.step_status.setText(['failed', 'apt', 'include'])
+        self.finished(FAILURE)
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import re
+import time
+
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+from buildbot.status.base import StatusReceiverMultiService
+
+from buildbot_ros_cfg.apt_repo import get_repository
+
+## @brief Keeps the artifacts uploaded to the master (binarydebs/ and sourcedebs/) in check.
+##        Every artifact is hardlinked into a content addressed store (artifacts/<sha256>),
+##        so identical uploads share their disk space. Old artifacts are removed once they
+##        are past the retention policy, and store objects no longer linked from anywhere
+##        are dropped. The work is done a few files at a time, from a LoopingCall.
+class ArtifactStore:
+
+    ## @brief Constructor
+    ## @param dirs Directories builds upload artifacts to
+    ## @param store Directory holding the content addressed objects
+    def __init__(self, dirs = ('binarydebs', 'sourcedebs'), store = 'artifacts'):
+        self.dirs = dirs
+        self.store = store
+        self.loop = None
+        self.work = list()  # files still to look at in this pass
+        self.configure()
+
+    ## @brief Set the retention policy. An artifact is kept while it is referenced by the
+    ##        APT repository (or one of its snapshots), or it is the newest artifact of its
+    ##        package, or it is one of the 'keep' newest and younger than max_age.
+    ## @param max_age Maximum age in days of artifacts which are not the newest
+    ## @param keep Number of artifacts to keep per package and distro (and arch)
+    ## @param interval Seconds between two steps of the garbage collection
+    ## @param batch Number of files to look at in each step
+    ## @param min_age Files modified more recently than this (in seconds) are left alone,
+    ##        as a build might still be using them
+    def configure(self, max_age = 30, keep = 3, interval = 60, batch = 50, min_age = 15*60):
+        self.max_age = max_age*24*60*60
+        self.keep = max(1, keep)
+        self.batch = batch
+        self.min_age = min_age
+        if self.loop and self.loop.running and self.interval != interval:
+            self.loop.stop()
+            self.loop.start(interval, now = False)
+        self.interval = interval
+
+    ## @brief Start garbage collection in the background, if not already running
+    def start(self):
+        if not self.loop:
+            self.loop = task.LoopingCall(self.step)
+        if not self.loop.running:
+            d = self.loop.start(self.interval, now = False)
+            d.addErrback(log.err, 'in artifact store')
+
+    ## @brief Stop garbage collection, the step in progress (if any) still finishes
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    @defer.inlineCallbacks
+    def step(self):
+        try:
+            if not self.work:
+                referenced = yield threads.deferToThread(get_repository().referenced_files)
+                self.work = yield threads.deferToThread(self._plan, set([os.path.basename(f) for f in referenced]))
+            work, self.work = self.work[:self.batch], self.work[self.batch:]
+            yield threads.deferToThread(self._process, work)
+        except Exception:
+            log.err(None, 'while collecting artifacts')
+            self.work = list()
+
+    ## @brief Group an artifact by package and Ubuntu distro (and arch, for debs). The
+    ##        sourcedeb archives are grouped by sourcedeb builder. Other artifacts are
+    ##        overwritten in place and are their own group.
+    def _group(self, directory, name):
+        parts = name.split('_')
+        if name.endswith('.deb') and len(parts) > 2:
+            return (directory, parts[0], self._distro(parts[1]), parts[-1])
+        if name.endswith('.dsc') and len(parts) > 1:
+            return (directory, parts[0], self._distro(parts[1][:-len('.dsc')]), '.dsc')
+        # <builder>_sourcedeb_<release_version>.tar, see sourcedeb_archive
+        if name.endswith('.tar') and '_sourcedeb_' in name:
+            return (directory, name.rsplit('_', 1)[0], '.tar')
+        return (directory, name)
+
+    ## @brief Get the Ubuntu distro a version was built for, our versions end with it
+    ##        (for instance, '0.1.0-0-20140101-1200-+0000precise')
+    def _distro(self, version):
+        match = re.search('[a-z]+$', version)
+        if match:
+            return match.group(0)
+        return None
+
+    ## @brief Decide what to do with every file
+    ## @param referenced Names of the debs referenced by the APT repository
+    ## @returns A list of (action, path), with action being 'delete', 'link' or 'orphan'
+    def _plan(self, referenced):
+        now = time.time()
+        groups = dict()
+        for directory in self.dirs:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                groups.setdefault(self._group(directory, name), list()).append((st.st_mtime, name, path, st.st_nlink))
+        work = list()
+        for group in groups.values():
+            group.sort(reverse = True)
+            for rank, (mtime, name, path, nlink) in enumerate(group):
+                if now - mtime < self.min_age:
+                    continue
+                if name in referenced or rank == 0 or (rank < self.keep and now - mtime < self.max_age):
+                    if nlink == 1:
+                        work.append(('link', path))
+                else:
+                    work.append(('delete', path))
+        if os.path.isdir(self.store):
+            for name in os.listdir(self.store):
+                work.append(('orphan', os.path.join(self.store, name)))
+        log.msg('artifact_store: %d files to look at' % len(work))
+        return work
+
+    def _process(self, work):
+        deleted = linked = saved = 0
+        for action, path in work:
+            try:
+                if action == 'delete':
+                    os.remove(path)
+                    deleted += 1
+                elif action == 'orphan':
+                    # nothing links to this object anymore
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        deleted += 1
+                elif action == 'link':
+                    if self._link(path):
+                        saved += os.path.getsize(path)
+                    linked += 1
+            except OSError as e:
+                log.msg('artifact_store: could not %s %s: %s' % (action, path, e))
+        if deleted or linked:
+            log.msg('artifact_store: deleted %d, stored %d files, %d bytes deduplicated' % (deleted, linked, saved))
+
+    ## @brief Put a file in the store, or replace it by a link to an identical stored file
+    ## @returns True if the file was a duplicate
+    def _link(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha.update(chunk)
+        obj = os.path.join(self.store, sha.hexdigest())
+        if not os.path.isdir(self.store):
+            os.makedirs(self.store)
+        if not os.path.exists(obj):
+            os.link(path, obj)
+            return False
+        # rename over the original, so it never goes missing
+        if os.path.exists(path+'.dedup'):
+            os.remove(path+'.dedup')
+        mtime = os.path.getmtime(path)
+        os.link(obj, path+'.dedup')
+        os.rename(path+'.dedup', path)
+        # links share their mtime, keep the newest so the retention policy still sees the upload
+        if mtime > os.path.getmtime(obj):
+            os.utime(obj, (time.time(), mtime))
+        return True
+
+_store = None
+
+## @brief Get the ArtifactStore of this master. This survives a reconfig, since
+##        modules are not reloaded.
+def get_artifact_store():
+    global _store
+    if _store == None:
+        _store = ArtifactStore()
+    return _store
+
+## @brief Runs the garbage collection of the ArtifactStore while the master is running. Add
+##        it to c['status'] in master.cfg, so nothing is started when the configuration is
+##        only loaded (for instance by 'buildbot checkconfig'). The status targets are
+##        replaced on every reconfig, the ArtifactStore and its progress are kept.
+class ArtifactCollector(StatusReceiverMultiService):
+
+    ## @brief Constructor, see ArtifactStore.configure for the parameters
+    def __init__(self, **kwargs):
+        StatusReceiverMultiService.__init__(self)
+        self.options = kwargs
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        store = get_artifact_store()
+        store.configure(**self.options)
+        store.start()
+
+    def stopService(self):
+        get_artifact_store().stop()
+        return StatusReceiverMultiService.stopService(self)
@@ -0,0 +1,53 @@
+import json
+
+from buildbot.status.results import SUCCESS
+from buildbot.steps.shell import ShellCommand
+
+from buildbot_ros_cfg.helpers import cache_dir
+
+## Maximum size of each ccache directory, ccache evicts the oldest objects past it
+CCACHE_SIZE = '5G'
+
+## @brief Directory on the slave holding the ccache of a distro and arch, shared by
+##        the debbuilds and testbuilds (see build_repo_debs.py and testbuild.py)
+def ccache_dir(distro, arch):
+    return cache_dir(distro, arch)+'/ccache'
+
+## @brief Publishes the ccache statistics written by a build (ccache.json, see
+##        scripts/ccache_helpers.py) as the ccache_hits, ccache_misses,
+##        ccache_hit_rate and ccache_size properties. The cache is shared, so builds
+##        running at the same time are counted in each other's statistics.
+class CcacheStats(ShellCommand):
+
+    name = 'ccache'
+    description = ['ccache', 'stats']
+    descriptionDone = ['ccache']
+    flunkOnFailure = False
+    warnOnFailure = False
+
+    ## @param stats Path of the ccache.json written by the build, on the slave
+    def __init__(self, stats, **kwargs):
+        ShellCommand.__init__(self, command = ['cat', stats], **kwargs)
+
+    def commandComplete(self, cmd):
+        stats = None
+        if not cmd.didFail():
+            try:
+                stats = json.loads(cmd.logs['stdio'].getText())
+            except ValueError:
+                pass
+        if stats == None:
+            self.descriptionDone = ['ccache', 'no stats']
+            return
+        hits = stats.get('hits', 0)
+        misses = stats.get('misses', 0)
+        rate = 100.0 * hits / (hits + misses) if hits + misses > 0 else 0.0
+        self.setProperty('ccache_hits', hits, 'CcacheStats')
+        self.setProperty('ccache_misses', misses, 'CcacheStats')
+        self.setProperty('ccache_hit_rate', round(rate, 1), 'CcacheStats')
+        self.setProperty('ccache_size', stats.get('size'), 'CcacheStats')
+        self.descriptionDone = ['ccache', '%.0f%% hits' % rate, '(%d/%d)' % (hits, hits + misses)]
+
+    def evaluateCommand(self, cmd):
+        # missing statistics (the build failed before writing them) are not a problem
+        return SUCCESS
@@ -0,0 +1,201 @@
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.schedulers import timed
+from buildbot.status.results import SUCCESS, WARNINGS
+
+from buildbot_ros_cfg.graph import reverse_closure, strongly_connected_components
+
+# Run state of each scheduler, by name. When its configuration changes, the scheduler
+# is replaced by a new instance, which picks up the run where the old one stopped.
+_run_states = dict()
+
+## @brief Nightly scheduler that walks a dependency graph of builders. Rather than
+##        starting one builder and relying on each job to trigger the next one, every
+##        builder is started as soon as all of the builders it depends on have finished.
+##        Builders that fail still release their dependents, as the old trigger chain did.
+##        If versions are given and only_changed is set, only builders whose version differs
+##        from the last successful build, plus everything depending on them, are built.
+##        Builders in a dependency cycle do not wait on each other.
+class DependencyScheduler(timed.Nightly):
+
+    compare_attrs = timed.Nightly.compare_attrs + ('depends', 'max_concurrent', 'versions', 'only_changed', 'run_timeout')
+
+    ## @brief Constructor
+    ## @param name Name of this scheduler
+    ## @param depends Dictionary of builder name -> list of builder names it depends on
+    ## @param max_concurrent Maximum number of builds this scheduler will have in flight
+    ## @param versions Dictionary of builder name -> version that builder currently builds
+    ## @param only_changed Only build builders whose version changed, and their dependents
+    ## @param run_timeout Seconds after which a run which has not finished is abandoned,
+    ##        so that one stuck run does not block every later one
+    ## @param kwargs Passed on to timed.Nightly (hour, minute, branch, etc)
+    def __init__(self, name, depends, max_concurrent = 1, versions = None, only_changed = False,
+                 run_timeout = 20*60*60, **kwargs):
+        timed.Nightly.__init__(self, name = name, builderNames = sorted(depends.keys()), **kwargs)
+        # only keep dependencies on builders this scheduler knows about
+        self.depends = dict()
+        for builder, deps in depends.items():
+            self.depends[builder] = sorted(set([d for d in deps if d in depends and d != builder]))
+        # builders in a cycle could never start, so drop the dependencies within each cycle
+        for component in strongly_connected_components(self.depends):
+            if len(component) > 1:
+                log.msg('%s: not ordering the dependency cycle between %s' % (name, ', '.join(component)))
+                for builder in component:
+                    self.depends[builder] = [d for d in self.depends[builder] if d not in component]
+        self.max_concurrent = max(1, max_concurrent)
+        self.versions = versions or dict()
+        self.only_changed = only_changed
+        self.run_timeout = run_timeout
+
+        self._dependents = dict([(builder, list()) for builder in self.depends.keys()])
+        for builder, deps in self.depends.items():
+            for d in deps:
+                self._dependents[d].append(builder)
+
+        self._waiting = dict()   # builder -> number of unfinished builders it depends on
+        self._ready = list()     # builders that can start right now
+        self._buildsets = dict() # bsid -> builder, for builds in flight
+        self._started = 0
+        self._run_started = None
+        self._built_versions = dict() # builder -> version of the last successful build
+        self._completion_subscr = None
+
+    def startService(self, *args, **kwargs):
+        d = timed.Nightly.startService(self, *args, **kwargs)
+        self._completion_subscr = self.master.subscribeToBuildsetCompletions(self._buildsetCompleted)
+        state = _run_states.pop(self.name, None)
+        if state:
+            r = self._restoreRun(state)
+            r.addErrback(log.err, 'while restoring the run of %s' % self.name)
+        return d
+
+    def stopService(self):
+        if self._completion_subscr:
+            self._completion_subscr.unsubscribe()
+            self._completion_subscr = None
+        if self._waiting or self._ready or self._buildsets:
+            _run_states[self.name] = {'pending': set(self._waiting.keys()) | set(self._ready),
+                                      'buildsets': dict(self._buildsets),
+                                      'run_started': self._run_started}
+        return timed.Nightly.stopService(self)
+
+    ## @brief Called by timed.Nightly when it is time to build
+    @defer.inlineCallbacks
+    def startBuild(self):
+        if self._waiting or self._buildsets:
+            if self._run_started != None and time.time() - self._run_started < self.run_timeout:
+                log.msg('%s: previous run is still in progress, not starting another' % self.name)
+                return
+            log.msg('%s: abandoning previous run, %d builders still waiting and %d building' %
+                    (self.name, len(self._waiting), len(self._buildsets)))
+            self._buildsets = dict()
+            self._started = 0
+        self._built_versions = yield self.getState('built_versions', {})
+        if self.only_changed:
+            builders = self._changedBuilders()
+        else:
+            builders = self.depends.keys()
+        self._startRun(builders)
+        yield self._dispatch()
+
+    ## @brief Get the builders whose version changed since their last successful
+    ##        build, plus all of the builders which depend on those
+    def _changedBuilders(self):
+        changed = set()
+        for builder in self.depends.keys():
+            if builder not in self.versions or self._built_versions.get(builder) != self.versions[builder]:
+                changed.add(builder)
+        builders = changed | reverse_closure(self._dependents, changed)
+        log.msg('%s: %d builders changed, %d need to be built' % (self.name, len(changed), len(builders)))
+        return builders
+
+    ## @brief Reset the state for a run over a set of builders
+    def _startRun(self, builders):
+        builders = set(builders)
+        self._run_started = time.time()
+        self._waiting = dict()
+        self._ready = list()
+        for builder in builders:
+            count = len([d for d in self.depends[builder] if d in builders])
+            if count == 0:
+                self._ready.append(builder)
+            else:
+                self._waiting[builder] = count
+        self._ready.sort()
+        log.msg('%s: starting run of %d builders, %d ready' % (self.name, len(builders), len(self._ready)))
+
+    ## @brief Continue a run started by the scheduler this one replaced. The
+    ##        dependencies may have changed, so the waiting counts are recomputed.
+    @defer.inlineCallbacks
+    def _restoreRun(self, state):
+        if state['run_started'] != None and time.time() - state['run_started'] >= self.run_timeout:
+            log.msg('%s: not continuing the previous run, it timed out' % self.name)
+            return
+        self._built_versions = yield self.getState('built_versions', {})
+        self._run_started = state['run_started']
+        self._buildsets = dict(state['buildsets'])
+        self._started = len(self._buildsets)
+        pending = set([b for b in state['pending'] if b in self.depends])
+        unfinished = pending | set(self._buildsets.values())
+        self._waiting = dict()
+        self._ready = list()
+        for builder in pending:
+            count = len([d for d in self.depends[builder] if d in unfinished])
+            if count == 0:
+                self._ready.append(builder)
+            else:
+                self._waiting[builder] = count
+        self._ready.sort()
+        log.msg('%s: continuing previous run, %d builders waiting, %d ready and %d building' %
+                (self.name, len(self._waiting), len(self._ready), len(self._buildsets)))
+        # buildsets which completed while no scheduler was listening
+        for bsid in list(self._buildsets.keys()):
+            bs = yield self.master.db.buildsets.getBuildset(bsid)
+            if bs and bs['complete']:
+                self._buildsetCompleted(bsid, bs['results'])
+        yield self._dispatch()
+
+    ## @brief Start as many ready builders as we are allowed to
+    @defer.inlineCallbacks
+    def _dispatch(self):
+        while self._ready and self._started < self.max_concurrent:
+            builder = self._ready.pop(0)
+            self._started += 1
+            try:
+                bsid, brids = yield self.addBuildsetForLatest(reason = 'dependencies of %s finished' % builder,
+                                                              branch = self.branch,
+                                                              builderNames = [builder, ])
+            except Exception:
+                log.err(None, '%s: failed to start %s' % (self.name, builder))
+                self._started -= 1
+                self._release(builder)
+                continue
+            self._buildsets[bsid] = builder
+
+    ## @brief Mark a builder as finished, readying any builders waiting on it
+    def _release(self, builder):
+        # the builder may have been removed by a reconfig while it was building
+        for dependent in self._dependents.get(builder, []):
+            if dependent not in self._waiting:
+                continue
+            self._waiting[dependent] -= 1
+            if self._waiting[dependent] == 0:
+                del self._waiting[dependent]
+                self._ready.append(dependent)
+        self._ready.sort()
+
+    def _buildsetCompleted(self, bsid, result):
+        if bsid not in self._buildsets:
+            return
+        builder = self._buildsets.pop(bsid)
+        self._started -= 1
+        if result in (SUCCESS, WARNINGS) and builder in self.versions:
+            self._built_versions[builder] = self.versions[builder]
+            d = self.setState('built_versions', self._built_versions)
+            d.addErrback(log.err, 'while saving built versions for %s' % self.name)
+        self._release(builder)
+        d = self._dispatch()
+        d.addErrback(log.err, 'while dispatching builds for %s' % self.name)
@@ -1,10 +1,17 @@
 from __future__ import print_function
 
+import hashlib
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from catkin_pkg.package import parse_package_string
 from rosdistro import *
-from rosdistro.dependency_walker import *
 from rosdistro.release import *
 
-from buildbot_ros_cfg.ros_deb import ros_debbuild
+from buildbot_ros_cfg.graph import topological_sort, reverse_graph, reverse_closure
+from buildbot_ros_cfg.ros_deb import ros_sourcedebbuild, ros_debbuild, sourcedeb_name, debbuild_name
 from buildbot_ros_cfg.ros_test import ros_testbuild
 from buildbot_ros_cfg.ros_doc import ros_docbuild
 
@@ -12,81 +19,161 @@ from buildbot_ros_cfg.ros_doc import ros_docbuild
 class RosDistroOracle:
     # TODO: use release file blacklist and drop those packages.
 
+    # bump this whenever the contents of build_order change, to invalidate old caches
+    CACHE_VERSION = 3
+
     ## @brief Constructor
     ## @param index A rosdistro.Index instance
     ## @param distros A list of ROS distribution names
-    def __init__(self, index, distro_names):
+    ## @param cache_file Optional path of a file used to cache the computed build
+    ##        order and dependency maps between restarts. Distributions whose
+    ##        files have not changed are loaded from the cache rather than recomputed.
+    ## @param threads Number of distributions to load at once
+    def __init__(self, index, distro_names, cache_file = None, threads = 8):
         self.index = index
         self.distro_names = distro_names
         self.distributions = {}
 
         self.build_order = {}
         self.build_files = {}
+        self.distribution_files = {}
+        self.distribution_build_files = {}
+        self.distribution_hashes = {}
+
+        cache = self._load_cache(cache_file)
 
-        for dist_name in distro_names:
-            self.distributions[dist_name] = get_cached_distribution(index, dist_name, allow_lazy_load = True)
-            dist = self.distributions[dist_name]
-
-            self.build_order[dist_name] = dict()
-
-            pkg_depends = dict()
-            packages = dist.release_packages.keys()
-            walker = DependencyWalker(dist)
-
-            # compute dependency of each package
-            for pkg in packages:
-                if dist.repositories[dist.release_packages[pkg].repository_name].release_repository.version == None:
-                    continue
-                pkg_depends[pkg] = list()
-                depends = walker.get_depends(pkg, 'buildtool')
-                depends |= walker.get_depends(pkg, 'build')
-                depends |= walker.get_depends(pkg, 'run')
-                for dp in depends:
-                    if dp in packages:
-                        pkg_depends[pkg].append(dp)
-
-            # this gives order for packages within a single repo of the debbuild
-            for repo in dist.repositories.keys():
-                if dist.repositories[repo].release_repository == None:
-                    continue
-                if dist.repositories[repo].release_repository.version == None:
-                    continue
-                order = list()
-                for pkg in dist.repositories[repo].release_repository.package_names:
-                    self._insert(pkg, pkg_depends[pkg], order)
-                self.build_order[dist_name][repo] = order
-
-            # this gives the order of the debbuilds
-            order = list()
-            for repo in dist.repositories.keys():
-                if dist.repositories[repo].release_repository == None:
-                    continue
-                if dist.repositories[repo].release_repository.version == None:
-                    continue
-
-                depends = list()
-                for pkg in dist.repositories[repo].release_repository.package_names:
-                    for dep in pkg_depends[pkg]:
-                        rd = dist.release_packages[dep].repository_name
-                        if rd not in depends:
-                            depends.append(rd)
-                self._insert(repo, depends, order)
-
-            self.build_order[dist_name]['deb_jobs'] = order
-
-            self.build_files[dist_name] = dict()
-            # TODO: this is a bit hacky, come up with a better way to get 'correct' build
-            self.build_files[dist_name]['release'] = get_release_build_files(self.index, dist_name)[0]
-            self.build_files[dist_name]['source'] = get_source_build_files(self.index, dist_name)[0]
-            self.build_files[dist_name]['doc'] = get_doc_build_files(self.index, dist_name)[0]
-
-            # build a list of doc jobs, all doc jobs must be released,
-            # but not all released things should need to be documented
-            self.build_order[dist_name]['doc_jobs'] = list()
-            doc = get_doc_file(self.index, dist_name)
-            for repo in order:
-                if repo in doc.repositories.keys():
-                    self.build_order[dist_name]['doc_jobs'].append(repo)
+        # most of the time loading is spent waiting on HTTP, so load distributions in parallel
+        pool = ThreadPool(max(1, min(threads, len(distro_names))))
+        try:
+            pool.map(lambda dist_name: self._load_distribution(dist_name, cache), distro_names)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._save_cache(cache_file)
+
+    ## @brief Load the files of a distribution, and compute (or load from cache) its build order
+    ## @param dist_name The ROS distribution name
+    ## @param cache The cache loaded by _load_cache
+    def _load_distribution(self, dist_name, cache):
+        start = time.time()
+
+        self.distribution_files[dist_name] = {'release': get_release_file(self.index, dist_name),
+                                              'source': get_source_file(self.index, dist_name),
+                                              'doc': get_doc_file(self.index, dist_name)}
+        self.distribution_build_files[dist_name] = {'release': get_release_build_files(self.index, dist_name),
+                                                    'source': get_source_build_files(self.index, dist_name),
+                                                    'doc': get_doc_build_files(self.index, dist_name)}
+        self.build_files[dist_name] = dict()
+        # TODO: this is a bit hacky, come up with a better way to get 'correct' build
+        for build in ['release', 'source', 'doc']:
+            self.build_files[dist_name][build] = self.distribution_build_files[dist_name][build][0]
+
+        self.distribution_hashes[dist_name] = self._hash_distribution(dist_name)
+        cached = cache.get(dist_name, {})
+        if cached.get('hash') == self.distribution_hashes[dist_name]:
+            self.build_order[dist_name] = cached['build_order']
+            print('Loaded %s in %.1f seconds, using cached build order' % (dist_name, time.time() - start))
+        else:
+            self.build_order[dist_name] = self._compute_build_order(dist_name)
+            print('Loaded %s in %.1f seconds, computed build order' % (dist_name, time.time() - start))
+
+    ## @brief Compute the build order for a distribution
+    ## @param dist_name The ROS distribution name
+    def _compute_build_order(self, dist_name):
+        self.distributions[dist_name] = get_cached_distribution(self.index, dist_name, allow_lazy_load = True)
+        dist = self.distributions[dist_name]
+
+        build_order = dict()
+
+        # one pass over the released packages, parsing each package.xml once
+        packages = set(dist.release_packages.keys())
+        pkg_depends = dict()
+        for pkg in packages:
+            if dist.repositories[dist.release_packages[pkg].repository_name].release_repository.version == None:
+                continue
+            xml = parse_package_string(dist.get_release_package_xml(pkg))
+            depends = set([d.name for d in xml.buildtool_depends + xml.build_depends + xml.run_depends])
+            depends &= packages
+            depends.discard(pkg)
+            pkg_depends[pkg] = depends
+        pkg_rdepends = reverse_graph(pkg_depends)
+        build_order['package_depends'] = dict([(k, sorted(v)) for k, v in pkg_depends.items()])
+        build_order['package_rdepends'] = dict([(k, sorted(v)) for k, v in pkg_rdepends.items()])
+
+        released = list()
+        for repo in sorted(dist.repositories.keys()):
+            if dist.repositories[repo].release_repository == None:
+                continue
+            if dist.repositories[repo].release_repository.version == None:
+                continue
+            released.append(repo)
+
+        # this gives order for packages within a single repo of the debbuild
+        for repo in released:
+            repo_packages = dist.repositories[repo].release_repository.package_names
+            build_order[repo] = topological_sort(
+                dict([(pkg, pkg_depends[pkg]) for pkg in repo_packages]))[0]
+
+        # this gives the order of the debbuilds, and the repositories each depends on
+        build_order['deb_depends'] = dict()
+        for repo in released:
+            depends = set()
+            for pkg in dist.repositories[repo].release_repository.package_names:
+                for dep in pkg_depends[pkg]:
+                    depends.add(dist.release_packages[dep].repository_name)
+            depends.discard(repo)
+            build_order['deb_depends'][repo] = sorted(depends)
+        build_order['deb_rdepends'] = dict([(k, sorted(v)) for k, v in reverse_graph(build_order['deb_depends']).items()])
+
+        order, waves = topological_sort(build_order['deb_depends'])
+        build_order['deb_jobs'] = order
+        build_order['deb_waves'] = waves
+
+        # build a list of doc jobs, all doc jobs must be released,
+        # but not all released things should need to be documented
+        build_order['doc_jobs'] = list()
+        doc = self.distribution_files[dist_name]['doc']
+        for repo in order:
+            if repo in doc.repositories:
+                build_order['doc_jobs'].append(repo)
+
+        return build_order
+
+    ## @brief Get a hash of the files that the build order is computed from,
+    ##        used to decide whether a cached build order is still valid
+    ## @param dist_name The ROS distribution name
+    def _hash_distribution(self, dist_name):
+        files = self.distribution_files[dist_name]
+        return distribution_hash([files['release'], files['doc']])
+
+    def _load_cache(self, cache_file):
+        if cache_file == None or not os.path.exists(cache_file):
+            return dict()
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache.get('version') != self.CACHE_VERSION:
+                return dict()
+            return cache['distributions']
+        except (IOError, ValueError, KeyError) as e:
+            print('Unable to read build order cache %s: %s' % (cache_file, e))
+            return dict()
+
+    def _save_cache(self, cache_file):
+        if cache_file == None:
+            return
+        cache = {'version': self.CACHE_VERSION, 'distributions': dict()}
+        for dist_name in self.distro_names:
+            cache['distributions'][dist_name] = {'hash': self.distribution_hashes[dist_name],
+                                                 'build_order': self.build_order[dist_name]}
+        try:
+            # write to a temporary file and rename, so a crash never leaves a partial cache
+            with open(cache_file+'.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.rename(cache_file+'.tmp', cache_file)
+        except (IOError, OSError) as e:
+            print('Unable to write build order cache %s: %s' % (cache_file, e))
 
     ## @brief Get the order to build debian packages within a single repository
     def getPackageOrder(self, repo_name, dist_name):
@@ -96,18 +183,33 @@ class RosDistroOracle:
     def getDebJobOrder(self, dist_name):
         return self.build_order[dist_name]['deb_jobs']
 
+    ## @brief Get the debian jobs grouped into waves, each of which only depends
+    ##        on jobs in earlier waves and so can be built concurrently
+    def getDebJobWaves(self, dist_name):
+        return self.build_order[dist_name]['deb_waves']
+
+    ## @brief Get the repositories that must be built before this one
+    def getDebJobDepends(self, repo_name, dist_name):
+        return self.build_order[dist_name]['deb_depends'][repo_name]
+
+    ## @brief Get the repositories that must be rebuilt if this one changes
+    ## @returns A set of repository names, not including repo_name
+    def getDebJobReverseDepends(self, repo_name, dist_name):
+        return reverse_closure(self.build_order[dist_name]['deb_rdepends'], [repo_name, ])
+
+    ## @brief Get the released packages that this package depends on directly
+    def getPackageDepends(self, pkg_name, dist_name):
+        return self.build_order[dist_name]['package_depends'][pkg_name]
+
+    ## @brief Get the released packages that must be rebuilt if this one changes
+    ## @returns A set of package names, not including pkg_name
+    def getPackageReverseDepends(self, pkg_name, dist_name):
+        return reverse_closure(self.build_order[dist_name]['package_rdepends'], [pkg_name, ])
+
     ## @brief Get the order for documentation jobs
     def getDocJobOrder(self, dist_name):
         return self.build_order[dist_name]['doc_jobs']
 
-    ## @brief Get the job to trigger after this one
-    def getDebTrigger(self, repo_name, dist_name):
-        i = self.build_order[dist_name]['deb_jobs'].index(repo_name)
-        try:
-            return [self.build_order[dist_name]['deb_jobs'][i+1], ]
-        except:
-            return None
-
     ## @brief Get the job to trigger after this one
     def getDocTrigger(self, repo_name, dist_name):
         i = self.build_order[dist_name]['doc_jobs'].index(repo_name)
@@ -116,14 +218,22 @@ class RosDistroOracle:
         except:
             return None
 
-    ## @brief Get the job to start nightly build with
-    def getNightlyDebStart(self, dist_name):
-        return self.build_order[dist_name]['deb_jobs'][0]
-
     ## @brief Get the job to start nightly build with
     def getNightlyDocStart(self, dist_name):
         return self.build_order[dist_name]['doc_jobs'][0]
 
+    ## @brief Get the release, source or doc file of a distribution
+    ## @param build The type of the file, 'release', 'source', or 'doc'
+    ## @param rosdistro The rosdistro name, 'groovy'
+    def getDistributionFile(self, build, rosdistro):
+        return self.distribution_files[rosdistro][build]
+
+    ## @brief Get all of the build files of a distribution
+    ## @param build The type of the build, 'release', 'source', or 'doc'
+    ## @param rosdistro The rosdistro name, 'groovy'
+    def getBuildFiles(self, build, rosdistro):
+        return self.distribution_build_files[rosdistro][build]
+
     ## @brief Get the rosdistro.Index
     def getIndex(self):
         return self.index
@@ -180,24 +290,53 @@ class RosDistroOracle:
         #return build_file.get_target_configuration()['apt_keys']
         return build_file._targets['_config']['apt_keys']
 
-    def _insert(self, name, depends, order):
-        for i in range(len(order)):
-            if order[len(order)-i-1] in depends:
-                order.insert(len(order)-i, name)
-                return
-        order.insert(0, name)
+## @brief Get a hash of the contents of distribution files which are already loaded,
+##        so that nothing is downloaded again just to hash it
+## @param files List of rosdistro file objects (release, source or doc file)
+def distribution_hash(files):
+    h = hashlib.sha1()
+    for dist_file in files:
+        h.update(json.dumps(dist_file.get_data(), sort_keys = True).encode('utf-8'))
+    return h.hexdigest()
+
+## @brief Get the jobs described by a distribution, used to find out what changed
+##        when the rosdistro is updated
+## @param release The release file of the distribution
+## @param source The source file of the distribution
+## @param doc The doc file of the distribution
+## @returns A dictionary of 'type/repository' -> 'url version'
+def distribution_jobs(release, source, doc):
+    jobs = dict()
+    for job_type, dist_file in [('release', release), ('source', source), ('doc', doc)]:
+        for name, repo in dist_file.repositories.items():
+            jobs[job_type+'/'+name] = '%s %s' % (repo.url, repo.version)
+    return jobs
 
 ## @brief Create debbuilders from release file
 ## @param c The Buildmasterconfig
 ## @param oracle The rosdistro oracle
 ## @param distro The distro to configure for ('groovy', 'hydro', etc)
 ## @param builders list of builders that this job can run on
-## @returns A list of debbuilder names created
+## @returns A list of sourcedeb and debbuilder names created
 def debbuilders_from_rosdistro(c, oracle, distro, builders):
-    rel = get_release_file(oracle.getIndex(), distro)
-    build_files = get_release_build_files(oracle.getIndex(), distro)
+    rel = oracle.getDistributionFile('release', distro)
+    build_files = oracle.getBuildFiles('release', distro)
     jobs = list()
 
+    # merge the targets of all the build files, each code name gets one sourcedeb
+    # job, and one debbuild job per architecture
+    code_names = list()
+    arches = dict()
+    for build_file in build_files:
+        for os in build_file.get_target_os_names():
+            for code_name in build_file.get_target_os_code_names(os):
+                if code_name not in arches:
+                    code_names.append(code_name)
+                    arches[code_name] = list()
+                for arch in build_file.get_target_arches(os, code_name):
+                    if arch not in arches[code_name]:
+                        arches[code_name].append(arch)
+
     for name in rel.repositories.keys():
         if rel.repositories[name].version == None:
             print('Skipping %s, since it has no version' % name)
@@ -205,24 +344,57 @@ def debbuilders_from_rosdistro(c, oracle, distro, builders):
         if rel.repositories[name].type != 'git':
             print('Cannot configure ros_debbuild for %s, as it is not a git repository' % name)
             continue
+        for code_name in code_names:
+            print('Configuring ros_sourcedebbuild job for: %s_%s' % (name, code_name))
+            jobs.append(ros_sourcedebbuild(c,
+                                           name,
+                                           oracle.getPackageOrder(name, distro),
+                                           rel.repositories[name].url,
+                                           code_name,
+                                           distro,
+                                           rel.repositories[name].version,  # release_version
+                                           builders))
+            for arch in arches[code_name]:
+                print('Configuring ros_debbuild job for: %s_%s_%s' % (name, code_name, arch))
+                jobs.append(ros_debbuild(c,
+                                         name,
+                                         oracle.getPackageOrder(name, distro),
+                                         code_name,
+                                         arch,
+                                         distro,
+                                         rel.repositories[name].version,  # release_version
+                                         builders,
+                                         oracle.getOtherMirror('release', distro, code_name),
+                                         oracle.getKeys('release', distro)))
+    return jobs
+
+## @brief Get the dependencies between debbuilders, used by the DependencyScheduler
+## @param oracle The rosdistro oracle
+## @param distro The distro to configure for ('groovy', 'hydro', etc)
+## @param jobs List of debbuilder names, as returned by debbuilders_from_rosdistro
+## @returns A dictionary of debbuilder name -> list of debbuilder names it depends on
+def debbuild_depends_from_rosdistro(oracle, distro, jobs):
+    build_files = oracle.getBuildFiles('release', distro)
+    jobs = set(jobs)
+    depends = dict()
+
+    for name in oracle.getDebJobOrder(distro):
         for build_file in build_files:
             for os in build_file.get_target_os_names():
                 for code_name in build_file.get_target_os_code_names(os):
                     for arch in build_file.get_target_arches(os, code_name):
-                        print('Configuring ros_debbuild job for: %s_%s_%s' % (name, code_name, arch))
-                        jobs.append(ros_debbuild(c,
-                                                 name,
-                                                 oracle.getPackageOrder(name, distro),
-                                                 rel.repositories[name].url,
-                                                 code_name,
-                                                 arch,
-                                                 distro,
-                                                 rel.repositories[name].version,  # release_version
-                                                 builders,
-                                                 oracle.getOtherMirror('release', distro, code_name),
-                                                 oracle.getKeys('release', distro),
-                                                 oracle.getDebTrigger(name, distro)))
-    return jobs
+                        job = debbuild_name(name, distro, code_name, arch)
+                        if job not in jobs:
+                            continue
+                        deps = [debbuild_name(d, distro, code_name, arch) for d in oracle.getDebJobDepends(name, distro)]
+                        # binaries are built from the source debs of this repository
+                        deps.append(sourcedeb_name(name, distro, code_name))
+                        depends[job] = [d for d in deps if d in jobs]
+                    # source debs only need the release repository
+                    job = sourcedeb_name(name, distro, code_name)
+                    if job in jobs:
+                        depends[job] = list()
+    return depends
 
 ## @brief Create testbuilders from source file
 ## @param c The Buildmasterconfig
@@ -234,8 +406,8 @@ def debbuilders_from_rosdistro(c, oracle, distro, builders):
 def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
     tokens = tokens or dict()
 
-    source = get_source_file(oracle.getIndex(), distro)
-    build_files = get_source_build_files(oracle.getIndex(), distro)
+    source = oracle.getDistributionFile('source', distro)
+    build_files = oracle.getBuildFiles('source', distro)
     jobs = list()
 
     for name in source.repositories.keys():
@@ -287,8 +459,8 @@ def testbuilders_from_rosdistro(c, oracle, distro, builders, tokens = None):
 ## @param builders list of builders that this job can run on
 ## @returns A list of debbuilder names created
 def docbuilders_from_rosdistro(c, oracle, distro, builders):
-    doc = get_doc_file(oracle.getIndex(), distro)
-    build_files = get_doc_build_files(oracle.getIndex(), distro)
+    doc = oracle.getDistributionFile('doc', distro)
+    build_files = oracle.getBuildFiles('doc', distro)
     jobs = list()
 
     for name in doc.repositories.keys():
@@ -312,3 +484,27 @@ def docbuilders_from_rosdistro(c, oracle, distro, builders):
                                                  oracle.getKeys('doc', distro),
                                                  oracle.getDocTrigger(name, distro)))
     return jobs
+
+## @brief Get the release version built by each debbuilder, used by the DependencyScheduler
+## @param oracle The rosdistro oracle
+## @param distro The distro to configure for ('groovy', 'hydro', etc)
+## @param jobs List of debbuilder names, as returned by debbuilders_from_rosdistro
+## @returns A dictionary of debbuilder name -> release version
+def debbuild_versions_from_rosdistro(oracle, distro, jobs):
+    rel = oracle.getDistributionFile('release', distro)
+    build_files = oracle.getBuildFiles('release', distro)
+    jobs = set(jobs)
+    versions = dict()
+
+    for name in oracle.getDebJobOrder(distro):
+        for build_file in build_files:
+            for os in build_file.get_target_os_names():
+                for code_name in build_file.get_target_os_code_names(os):
+                    for arch in build_file.get_target_arches(os, code_name):
+                        job = debbuild_name(name, distro, code_name, arch)
+                        if job in jobs:
+                            versions[job] = rel.repositories[name].version
+                    job = sourcedeb_name(name, distro, code_name)
+                    if job in jobs:
+                        versions[job] = rel.repositories[name].version
+    return versions
@@ -0,0 +1,127 @@
+from twisted.python import log
+
+## @brief Find the cycles of a dependency graph, as its strongly connected components,
+##        using Tarjan's algorithm (without recursion, graphs can be deep). O(nodes + edges).
+## @param depends Dictionary of name -> iterable of names it depends on. Names
+##        which are not keys of the dictionary are ignored.
+## @returns A list of components, each a sorted list of names. Every name is in exactly
+##          one component, a component of more than one name is a cycle. Components
+##          come after the components they depend on.
+def strongly_connected_components(depends):
+    edges = dict()
+    for name, deps in depends.items():
+        edges[name] = sorted(set([d for d in deps if d in depends and d != name]))
+
+    index = dict()
+    low = dict()
+    stack = list()
+    on_stack = set()
+    components = list()
+    for root in sorted(edges.keys()):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges[root]))]
+        while work:
+            name, deps = work[-1]
+            descended = False
+            for d in deps:
+                if d not in index:
+                    index[d] = low[d] = len(index)
+                    stack.append(d)
+                    on_stack.add(d)
+                    work.append((d, iter(edges[d])))
+                    descended = True
+                    break
+                elif d in on_stack:
+                    low[name] = min(low[name], index[d])
+            if descended:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[name])
+            if low[name] == index[name]:
+                component = list()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == name:
+                        break
+                components.append(sorted(component))
+    return components
+
+## @brief Sort a dependency graph into levels ("waves") using Kahn's algorithm.
+##        Everything in a wave depends only on things in earlier waves, so a wave
+##        can be built concurrently. Runs in O(nodes + edges).
+## @param depends Dictionary of name -> iterable of names it depends on. Names
+##        which are not keys of the dictionary are ignored.
+## @returns A tuple of (order, waves), where order is a flat list and waves is a
+##          list of lists. The members of a cycle are reported, and placed together in
+##          one wave: after everything the cycle depends on, and before everything
+##          depending on it.
+def topological_sort(depends):
+    components = strongly_connected_components(depends)
+    component_of = dict()
+    for i, component in enumerate(components):
+        if len(component) > 1:
+            log.msg('Dependency cycle detected between: %s' % ', '.join(component))
+        for name in component:
+            component_of[name] = i
+
+    # Kahn's algorithm over the graph of components, which has no cycles
+    dependents = dict([(i, set()) for i in range(len(components))])
+    waiting = dict()
+    for i, component in enumerate(components):
+        deps = set()
+        for name in component:
+            deps |= set([component_of[d] for d in depends[name] if d in component_of])
+        deps.discard(i)
+        waiting[i] = len(deps)
+        for d in deps:
+            dependents[d].add(i)
+
+    waves = list()
+    wave = [i for i, count in waiting.items() if count == 0]
+    while wave:
+        waves.append(sorted([name for i in wave for name in components[i]]))
+        next_wave = list()
+        for i in wave:
+            for dependent in dependents[i]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    next_wave.append(dependent)
+        wave = next_wave
+
+    order = [name for wave in waves for name in wave]
+    return order, waves
+
+## @brief Invert a dependency graph
+## @param depends Dictionary of name -> iterable of names it depends on
+## @returns Dictionary of name -> set of names which depend on it
+def reverse_graph(depends):
+    rdepends = dict([(name, set()) for name in depends])
+    for name, deps in depends.items():
+        for d in deps:
+            if d in rdepends and d != name:
+                rdepends[d].add(name)
+    return rdepends
+
+## @brief Find everything that transitively depends on any of the roots
+## @param rdepends Dictionary of name -> iterable of names which depend on it
+## @param roots Iterable of names to start from
+## @returns A set of names, not including the roots themselves unless they
+##          depend on another root
+def reverse_closure(rdepends, roots):
+    found = set()
+    stack = list(roots)
+    while stack:
+        name = stack.pop()
+        for dependent in rdepends.get(name, []):
+            if dependent not in found:
+                found.add(dependent)
+                stack.append(dependent)
+    return found
@@ -2,3 +2,18 @@ from buildbot.status import results
 
 def success(result, s):
      return (result == results.SUCCESS)
+
+## @brief Directory on the slaves holding the caches shared between builds. It needs to
+##        survive reboots (so not a tmpfs like /tmp often is), and be writable by the
+##        buildbot user. Change it with set_cache_root, before creating the builders.
+CACHE_ROOT = '/var/cache/buildbot-ros'
+
+## @brief Set the directory on the slaves holding the caches shared between builds
+def set_cache_root(path):
+    global CACHE_ROOT
+    CACHE_ROOT = path.rstrip('/')
+
+## @brief Directory on the slave shared between builds for a distro and arch (bind-mounted
+##        into the cowbuilder), for caches which outlive a single build.
+def cache_dir(distro, arch):
+    return CACHE_ROOT+'/'+distro+'_'+arch
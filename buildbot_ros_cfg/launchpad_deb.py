@@ -4,9 +4,9 @@ from buildbot.process.properties import Interpolate
 from buildbot.steps.shell import ShellCommand
 from buildbot.steps.transfer import FileUpload, FileDownload
 from buildbot.steps.trigger import Trigger
-from buildbot.steps.master import MasterShellCommand
 
 from helpers import success
+from apt_repo import AptInclude
 
 ## @brief Build a deb, from a source package found on launchpad
 ## @param c The Buildmasterconfig
@@ -51,7 +51,7 @@ def launchpad_debbuild(c, package, version, binaries, url, distro, arch, machine
         ShellCommand(
             haltOnFailure = True,
             name = package+'-build',
-            command = ['sudo', 'cowbuilder',
+            command = ['cowbuilder-run.py', distro, arch, 'sudo', 'cowbuilder',
                        '--build', package+'_'+version+'.dsc',
                        '--distribution', distro, '--architecture', arch,
                        '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
@@ -74,12 +74,14 @@ def launchpad_debbuild(c, package, version, binaries, url, distro, arch, machine
                     hideStepIf = success
                 )
             )
-            # Add the binarydeb using reprepro updater script on master
+            # Add the binarydeb to the APT repository, batched with other builds on the master
             f.addStep(
-                MasterShellCommand(
+                AptInclude(
                     name = deb_name+'-include',
-                    command = ['reprepro-include.bash', deb_name, Interpolate(debian_pkg), distro, deb_arch],
-                    descriptionDone = ['updated in apt', debian_pkg]
+                    package = deb_name,
+                    deb = debian_pkg,
+                    distro = distro,
+                    arch = deb_arch
                 )
             )
     # Trigger if needed
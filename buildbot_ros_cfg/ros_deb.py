@@ -1,38 +1,102 @@
+import os
+
 from buildbot.config import BuilderConfig
 from buildbot.process.factory import BuildFactory
 from buildbot.process.properties import Interpolate
 from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
 from buildbot.steps.transfer import FileUpload, FileDownload
-from buildbot.steps.trigger import Trigger
-from buildbot.steps.master import MasterShellCommand
 from buildbot.steps.slave import RemoveDirectory
-from buildbot.schedulers import triggerable
+from buildbot.process.buildstep import BuildStep
+from buildbot.status.results import SUCCESS
 
 from helpers import success
+from apt_repo import AptInclude, CheckPublished, deb_needed
+from ccache import CcacheStats, ccache_dir, CCACHE_SIZE
+
+## @brief Get the name of a debbuilder
+## @param job_name Name for the job (typically the metapackage name)
+## @param rosdistro ROS distro (for instance, 'groovy')
+## @param distro Ubuntu distro (for instance, 'precise')
+## @param arch Architecture (for instance, 'amd64')
+def debbuild_name(job_name, rosdistro, distro, arch):
+    return job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild'
+
+## @brief Get the name of a sourcedeb builder
+## @param job_name Name for the job (typically the metapackage name)
+## @param rosdistro ROS distro (for instance, 'groovy')
+## @param distro Ubuntu distro (for instance, 'precise')
+def sourcedeb_name(job_name, rosdistro, distro):
+    return job_name+'_'+rosdistro+'_'+distro+'_sourcedeb'
+
+## @brief Get the path on the master of the archive of source debs built by a sourcedeb
+##        builder, for the release version in the 'release_version' property
+## @param job_name Name for the job (typically the metapackage name)
+## @param rosdistro ROS distro (for instance, 'groovy')
+## @param distro Ubuntu distro (for instance, 'precise')
+def sourcedeb_archive(job_name, rosdistro, distro):
+    return Interpolate('sourcedebs/'+sourcedeb_name(job_name, rosdistro, distro)+'_%(prop:release_version)s.tar')
 
-## @brief Debbuilds are used for building sourcedebs & binaries out of gbps and uploading to an APT repository
+## @brief Master side step checking whether the archive of source debs of a release version
+##        was already uploaded. The result is stored in the 'deb_skip' property, as with
+##        CheckPublished, so later steps can use deb_needed as their doStepIf.
+class CheckArchive(BuildStep):
+
+    name = 'check-archive'
+    description = ['checking', 'archive']
+    descriptionDone = ['checked', 'archive']
+    renderables = ['archive']
+
+    ## @brief Constructor
+    ## @param archive Path of the archive on the master, may be renderable
+    def __init__(self, archive, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.archive = archive
+
+    def start(self):
+        skip = os.path.exists(self.archive)
+        self.setProperty('deb_skip', skip, 'CheckArchive')
+        if skip:
+            self.descriptionDone = ['already', 'built']
+        else:
+            self.descriptionDone = ['needs', 'build']
+        self.addCompleteLog('archive', '%s %s\n' % (self.archive, 'exists' if skip else 'does not exist'))
+        self.step_status.setText(self.descriptionDone)
+        self.finished(SUCCESS)
+
+## @brief Get the debian package name of a ROS package (ros-groovy-foo)
+def debian_package_name(package, rosdistro):
+    return 'ros-'+rosdistro+'-'+package.replace('_','-')
+
+## @brief Sourcedebs builds the source debs of a repository out of a gbp, once per Ubuntu
+##        distro. They are uploaded to the master as a single archive, which the debbuilds
+##        for each architecture then build binaries from.
 ## @param c The Buildmasterconfig
 ## @param job_name Name for this job (typically the metapackage name)
 ## @param packages List of packages to build.
 ## @param url URL of the BLOOM repository.
 ## @param distro Ubuntu distro to build for (for instance, 'precise')
-## @param arch Architecture to build for (for instance, 'amd64')
 ## @param rosdistro ROS distro (for instance, 'groovy')
 ## @param version Release version to build (for instance, '0.8.1-0')
 ## @param machines List of machines this can build on.
-## @param othermirror Cowbuilder othermirror parameter
-## @param keys List of keys that cowbuilder will need
-## @param trigger_pkgs List of packages names to trigger after our build is done.
-def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, machines, othermirror, keys, trigger_pkgs = None):
+def ros_sourcedebbuild(c, job_name, packages, url, distro, rosdistro, version, machines):
     gbp_args = ['-uc', '-us', '--git-ignore-branch', '--git-ignore-new',
-                '--git-verbose', '--git-dist='+distro, '--git-arch='+arch]
+                '--git-verbose', '--git-dist='+distro]
     f = BuildFactory()
+    # Skip everything if the source debs of this version were already uploaded. Whether
+    # the binaries are published is left to the debbuilds: an upstream include later in
+    # the same run can still remove them, and the debbuilds then need this archive.
+    f.addStep(
+        CheckArchive(
+            archive = sourcedeb_archive(job_name, rosdistro, distro)
+        )
+    )
     # Remove the build directory.
     f.addStep(
         RemoveDirectory(
             name = job_name+'-clean',
             dir = Interpolate('%(prop:workdir)s'),
+            doStepIf = deb_needed,
             hideStepIf = success,
         )
     )
@@ -42,38 +106,32 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
             repourl = url,
             branch = 'master',
             alwaysUseLatest = True, # this avoids broken builds when schedulers send wrong tag/rev
-            mode = 'full' # clean out old versions
+            mode = 'full', # clean out old versions
+            doStepIf = deb_needed
         )
     )
-    # Update the cowbuilder
+    # Download script for building the source deb
     f.addStep(
-        ShellCommand(
-            command = ['cowbuilder-update.py', distro, arch] + keys,
+        FileDownload(
+            name = job_name+'-grab-build-source-deb-script',
+            mastersrc = 'scripts/build_source_deb.py',
+            slavedest = Interpolate('%(prop:workdir)s/build_source_deb.py'),
+            mode = 0755,
+            doStepIf = deb_needed,
             hideStepIf = success
         )
     )
-    # Need to build each package in order
     for package in packages:
-        debian_pkg = 'ros-'+rosdistro+'-'+package.replace('_','-')  # debian package name (ros-groovy-foo)
+        debian_pkg = debian_package_name(package, rosdistro)
         branch_name = 'debian/'+debian_pkg+'_%(prop:release_version)s_'+distro  # release branch from bloom
         deb_name = debian_pkg+'_%(prop:release_version)s'+distro
-        final_name = debian_pkg+'_%(prop:release_version)s-%(prop:datestamp)s'+distro+'_'+arch+'.deb'
-        # Check out the proper tag. Use --force to delete changes from previous deb stamping
+        # Check out the proper tag.
         f.addStep(
             ShellCommand(
                 haltOnFailure = True,
                 name = package+'-checkout',
                 command = ['git', 'checkout', Interpolate(branch_name), '--force'],
-                hideStepIf = success
-            )
-        )
-        # Download script for building the source deb
-        f.addStep(
-            FileDownload(
-                name = job_name+'-grab-build-source-deb-script',
-                mastersrc = 'scripts/build_source_deb.py',
-                slavedest = Interpolate('%(prop:workdir)s/build_source_deb.py'),
-                mode = 0755,
+                doStepIf = deb_needed,
                 hideStepIf = success
             )
         )
@@ -84,6 +142,7 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
                 name = package+'-buildsource',
                 command= [Interpolate('%(prop:workdir)s/build_source_deb.py'),
                     rosdistro, package, Interpolate('%(prop:release_version)s')] + gbp_args,
+                doStepIf = deb_needed,
                 descriptionDone = ['sourcedeb', package]
             )
         )
@@ -93,101 +152,203 @@ def ros_debbuild(c, job_name, packages, url, distro, arch, rosdistro, version, m
                 name = package+'-uploadsource',
                 slavesrc = Interpolate('%(prop:workdir)s/'+deb_name+'.dsc'),
                 masterdest = Interpolate('sourcedebs/'+deb_name+'.dsc'),
+                doStepIf = deb_needed,
                 hideStepIf = success
             )
         )
-        # Stamp the changelog, in a similar fashion to the ROS buildfarm
-        f.addStep(
-            SetPropertyFromCommand(
-                command="date +%Y%m%d-%H%M-%z", property="datestamp",
-                name = package+'-getstamp',
-                hideStepIf = success
-            )
+    # Pack up the source packages (dsc and tarballs) for the debbuilds
+    f.addStep(
+        ShellCommand(
+            haltOnFailure = True,
+            name = job_name+'-packsources',
+            command = 'tar -cf sourcedebs.tar *.dsc *.tar.*',
+            workdir = Interpolate('%(prop:workdir)s'),
+            doStepIf = deb_needed,
+            hideStepIf = success
         )
-        f.addStep(
-            ShellCommand(
-                haltOnFailure = True,
-                name = package+'-stampdeb',
-                command = ['git-dch', '-a', '--ignore-branch', '--verbose',
-                           '-N', Interpolate('%(prop:release_version)s-%(prop:datestamp)s'+distro)],
-                descriptionDone = ['stamped changelog', Interpolate('%(prop:release_version)s'),
-                                   Interpolate('%(prop:datestamp)s')]
-            )
+    )
+    f.addStep(
+        FileUpload(
+            name = job_name+'-uploadsources',
+            slavesrc = Interpolate('%(prop:workdir)s/sourcedebs.tar'),
+            masterdest = sourcedeb_archive(job_name, rosdistro, distro),
+            doStepIf = deb_needed,
+            hideStepIf = success
         )
-        # download hooks
-        f.addStep(
-            FileDownload(
-                name = package+'-grab-hooks',
-                mastersrc = 'hooks/D05deps',
-                slavedest = Interpolate('%(prop:workdir)s/hooks/D05deps'),
-                hideStepIf = success,
-                mode = 0777 # make this executable for the cowbuilder
-            )
+    )
+    # Add to builders
+    c['builders'].append(
+        BuilderConfig(
+            name = sourcedeb_name(job_name, rosdistro, distro),
+            properties = {'release_version' : version},
+            slavenames = machines,
+            factory = f
         )
-        # Download script for building the binary deb
-        f.addStep(
-            FileDownload(
-                name = job_name+'-grab-build-binary-deb-script',
-                mastersrc = 'scripts/build_binary_deb.py',
-                slavedest = Interpolate('%(prop:workdir)s/build_binary_deb.py'),
-                mode = 0755,
-                hideStepIf = success
-            )
+    )
+    # return name of builder created
+    return sourcedeb_name(job_name, rosdistro, distro)
+
+## @brief Debbuilds are used for building binaries out of the source debs created by a
+##        sourcedeb builder (see ros_sourcedebbuild), and uploading them to an APT repository
+## @param c The Buildmasterconfig
+## @param job_name Name for this job (typically the metapackage name)
+## @param packages List of packages to build.
+## @param distro Ubuntu distro to build for (for instance, 'precise')
+## @param arch Architecture to build for (for instance, 'amd64')
+## @param rosdistro ROS distro (for instance, 'groovy')
+## @param version Release version to build (for instance, '0.8.1-0')
+## @param machines List of machines this can build on.
+## @param othermirror Cowbuilder othermirror parameter
+## @param keys List of keys that cowbuilder will need
+def ros_debbuild(c, job_name, packages, distro, arch, rosdistro, version, machines, othermirror, keys):
+    f = BuildFactory()
+    # Skip everything if this version is already published
+    f.addStep(
+        CheckPublished(
+            packages = [debian_package_name(package, rosdistro) for package in packages],
+            version = Interpolate('%(prop:release_version)s'),
+            distro = distro,
+            arches = [arch, ]
         )
-        # build the binary from the git working copy
-        f.addStep(
-            ShellCommand(
-                haltOnFailure = True,
-                name = package+'-buildbinary',
-                command = [Interpolate('%(prop:workdir)s/build_binary_deb.py'), debian_pkg,
-                    Interpolate('%(prop:release_version)s'), distro, Interpolate('%(prop:workdir)s')] + gbp_args,
-                env = {'DIST': distro,
-                       'GIT_PBUILDER_OPTIONS': Interpolate('--hookdir %(prop:workdir)s/hooks --override-config'),
-                       'OTHERMIRROR': othermirror },
-                descriptionDone = ['binarydeb', package]
-            )
+    )
+    # Remove the build directory.
+    f.addStep(
+        RemoveDirectory(
+            name = job_name+'-clean',
+            dir = Interpolate('%(prop:workdir)s'),
+            doStepIf = deb_needed,
+            hideStepIf = success,
         )
+    )
+    # Get the source debs of this release version from the master, built once for all
+    # architectures. If the sourcedeb builder has not built this version yet, this fails.
+    f.addStep(
+        FileDownload(
+            name = job_name+'-grab-sources',
+            haltOnFailure = True,
+            mastersrc = sourcedeb_archive(job_name, rosdistro, distro),
+            slavedest = Interpolate('%(prop:workdir)s/sourcedebs.tar'),
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    f.addStep(
+        ShellCommand(
+            haltOnFailure = True,
+            name = job_name+'-unpacksources',
+            command = ['tar', '-xf', 'sourcedebs.tar'],
+            workdir = Interpolate('%(prop:workdir)s'),
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # Update the cowbuilder
+    f.addStep(
+        ShellCommand(
+            command = ['cowbuilder-update.py', distro, arch] + keys,
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # The ccache is shared with the other builds for this distro and arch
+    ccachedir = ccache_dir(distro, arch)
+    f.addStep(
+        ShellCommand(
+            command = ['mkdir', '-p', ccachedir],
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # Download script for building the binary debs
+    f.addStep(
+        FileDownload(
+            name = job_name+'-grab-build-repo-debs-script',
+            mastersrc = 'scripts/build_repo_debs.py',
+            slavedest = Interpolate('%(prop:workdir)s/build_repo_debs.py'),
+            mode = 0755,
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # cowbuilder only copies the script it runs, the ccache helpers go in the bind-mounted workdir
+    f.addStep(
+        FileDownload(
+            name = job_name+'-grab-ccache-helpers',
+            mastersrc = 'scripts/ccache_helpers.py',
+            slavedest = Interpolate('%(prop:workdir)s/ccache_helpers.py'),
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # Stamp the changelog, in a similar fashion to the ROS buildfarm
+    f.addStep(
+        SetPropertyFromCommand(
+            command="date +%Y%m%d-%H%M-%z", property="datestamp",
+            name = job_name+'-getstamp',
+            doStepIf = deb_needed,
+            hideStepIf = success
+        )
+    )
+    # Build all packages in order, in one cowbuilder session. Each deb is added to a local
+    # repository in the chroot, so later packages can install it as a build dependency.
+    f.addStep(
+        ShellCommand(
+            haltOnFailure = True,
+            name = job_name+'-buildbinaries',
+            command = ['cowbuilder-run.py', distro, arch,
+                       'sudo', 'cowbuilder', '--execute', Interpolate('%(prop:workdir)s/build_repo_debs.py'),
+                       '--distribution', distro, '--architecture', arch,
+                       '--bindmounts', Interpolate('%(prop:workdir)s '+ccachedir),
+                       '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
+                       '--override-config', '--othermirror', othermirror,
+                       '--', '--ccache='+ccachedir, '--ccache-size='+CCACHE_SIZE,
+                       Interpolate('%(prop:workdir)s'),
+                       Interpolate('%(prop:release_version)s-%(prop:datestamp)s'+distro), distro] +
+                      [Interpolate(debian_package_name(package, rosdistro)+'_%(prop:release_version)s'+distro+'.dsc')
+                       for package in packages],
+            doStepIf = deb_needed,
+            descriptionDone = ['binarydeb', ] + packages
+        )
+    )
+    for package in packages:
+        debian_pkg = debian_package_name(package, rosdistro)
+        final_name = debian_pkg+'_%(prop:release_version)s-%(prop:datestamp)s'+distro+'_'+arch+'.deb'
         # Upload binarydeb to master
         f.addStep(
             FileUpload(
                 name = package+'-uploadbinary',
                 slavesrc = Interpolate('%(prop:workdir)s/'+final_name),
                 masterdest = Interpolate('binarydebs/'+final_name),
+                doStepIf = deb_needed,
                 hideStepIf = success
             )
         )
-        # Add the binarydeb using reprepro updater script on master
+        # Add the binarydeb to the APT repository, batched with other builds on the master
         f.addStep(
-            MasterShellCommand(
+            AptInclude(
                 name = package+'-includedeb',
-                command = ['reprepro-include.bash', debian_pkg, Interpolate(final_name), distro, arch],
-                descriptionDone = ['updated in apt', package]
+                package = debian_pkg,
+                deb = Interpolate(final_name),
+                distro = distro,
+                arch = arch,
+                doStepIf = deb_needed
             )
         )
-    # Trigger if needed
-    if trigger_pkgs != None:
-        f.addStep(
-            Trigger(
-                schedulerNames = [t.replace('_','-')+'-'+rosdistro+'-'+distro+'-'+arch+'-debtrigger' for t in trigger_pkgs],
-                waitForFinish = False,
-                alwaysRun=True
-            )
-        )
-    # Create trigger
-    c['schedulers'].append(
-        triggerable.Triggerable(
-            name = job_name.replace('_','-')+'-'+rosdistro+'-'+distro+'-'+arch+'-debtrigger',
-            builderNames = [job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',]
+    # Publish the ccache statistics of the build
+    f.addStep(
+        CcacheStats(
+            stats = Interpolate('%(prop:workdir)s/ccache.json'),
+            doStepIf = deb_needed
         )
     )
     # Add to builders
     c['builders'].append(
         BuilderConfig(
-            name = job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild',
+            name = debbuild_name(job_name, rosdistro, distro, arch),
             properties = {'release_version' : version},
             slavenames = machines,
             factory = f
         )
     )
     # return name of builder created
-    return job_name+'_'+rosdistro+'_'+distro+'_'+arch+'_debbuild'
+    return debbuild_name(job_name, rosdistro, distro, arch)
@@ -66,7 +66,8 @@ def ros_docbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, ot
         ShellCommand(
             haltOnFailure = True,
             name = job_name+'-docbuild',
-            command = ['sudo', 'cowbuilder', '--execute', Interpolate('%(prop:workdir)s/docbuild.py'),
+            command = ['cowbuilder-run.py', distro, arch,
+                       'sudo', 'cowbuilder', '--execute', Interpolate('%(prop:workdir)s/docbuild.py'),
                        '--distribution', distro, '--architecture', arch,
                        '--bindmounts', binddir,
                        '--basepath', '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
@@ -1,3 +1,5 @@
+import json
+
 from buildbot.config import BuilderConfig
 from buildbot.changes import base
 from buildbot.changes.filter import ChangeFilter
@@ -8,11 +10,12 @@ from buildbot.process.properties import Interpolate
 from buildbot.schedulers import basic
 from buildbot.status import results
 from buildbot.steps.source.git import Git
-from buildbot.steps.shell import ShellCommand
+from buildbot.steps.shell import ShellCommand, SetPropertyFromCommand
 from buildbot.steps.transfer import FileDownload
 
 from buildbot_ros_cfg.git_pr_poller import GitPRPoller
-from buildbot_ros_cfg.helpers import success
+from buildbot_ros_cfg.helpers import success, cache_dir
+from buildbot_ros_cfg.ccache import CcacheStats, ccache_dir, CCACHE_SIZE
 
 
 ## @brief Work around for GitPoller not allowing two instances
@@ -55,8 +58,14 @@ class NamedGitPoller(GitPoller):
 ## @param machines List of machines this can build on.
 ## @param othermirror Cowbuilder othermirror parameter
 ## @param keys List of keys that cowbuilder will need
+## @param token OAuth token, to build pull requests rather than the branch
+## @param jobs Number of parallel jobs to build and test with, by default
+##        detected from the cores and memory of the slave
+## @param incremental If True, keep the checkout and the build tree (one per branch)
+##        on the slave, and only rebuild what changed while the dependencies and
+##        toolchain stay the same
 def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines, 
-                  othermirror, keys, token=None):
+                  othermirror, keys, token=None, jobs=None, incremental=False):
 
     # Change source is either GitPoller or GitPRPoller
     # TODO: make this configurable for svn/etc
@@ -93,24 +102,57 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
         )
     )
 
-    # Directory which will be bind-mounted
-    binddir = '/tmp/'+project_name
+    # Directory shared between builds, bind-mounted
+    cachedir = cache_dir(distro, arch)
+    if incremental:
+        # The workspace is kept in the cache, the build trees next to it
+        binddir = cachedir+'/workspaces/'+project_name
+        bindmounts = cachedir
+    else:
+        # Directory which will be bind-mounted
+        binddir = '/tmp/'+project_name
+        bindmounts = binddir+' '+cachedir
+    # The ccache is in the cache directory, shared with the debbuilds
+    ccachedir = ccache_dir(distro, arch)
+    testbuild_args = [binddir, rosdistro, '--cache='+cachedir,
+                      '--ccache='+ccachedir, '--ccache-size='+CCACHE_SIZE]
+    if jobs:
+        testbuild_args.append('--jobs=%d' % jobs)
+    if incremental:
+        testbuild_args.append(Interpolate('--incremental=%(prop:branch:-'+branch+')s'))
 
     f = BuildFactory()
-    # Remove any old crud in /tmp folder
+    if incremental:
+        # Only remove the results of the last build
+        f.addStep(
+            ShellCommand(
+                command=['rm', '-f', binddir+'/testresults', binddir+'/testresults.json',
+                         binddir+'/ccache.json'],
+                hideStepIf=success
+            )
+        )
+    else:
+        # Remove any old crud in /tmp folder
+        f.addStep(
+            ShellCommand(
+                command=['rm', '-rf', binddir],
+                hideStepIf=success
+            )
+        )
     f.addStep(
         ShellCommand(
-            command=['rm', '-rf', binddir],
+            command=['mkdir', '-p', cachedir, ccachedir],
             hideStepIf=success
         )
     )
-    # Check out repository (to /tmp)
+    # Check out repository (to the bind-mounted workspace)
     f.addStep(
         Git(
             repourl=util.Property('repository', default=url),
             branch=util.Property('branch', default=branch),
             alwaysUseLatest=True,
-            mode='full',
+            # incremental leaves unchanged files (and their timestamps) alone
+            mode='incremental' if incremental else 'full',
             workdir=binddir+'/src/'+job_name
         )
     )
@@ -123,6 +165,15 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
             hideStepIf=success
         )
     )
+    # cowbuilder only copies the script it runs, the ccache helpers go in the bind-mounted workspace
+    f.addStep(
+        FileDownload(
+            name=job_name+'-grab-ccache-helpers',
+            mastersrc='scripts/ccache_helpers.py',
+            slavedest=binddir+'/ccache_helpers.py',
+            hideStepIf=success
+        )
+    )
     # Update the cowbuilder
     f.addStep(
         ShellCommand(
@@ -130,21 +181,40 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
             hideStepIf=success
         )
     )
+    # Get a cowbuilder with the dependencies already installed
+    f.addStep(
+        SetPropertyFromCommand(
+            name=job_name+'-layer',
+            command=['cowbuilder-layer.py', '--cache='+cachedir, distro, arch, rosdistro, binddir,
+                     Interpolate('%(prop:workdir)s/testbuild.py'), othermirror],
+            # the progress of cowbuilder-layer.py goes to stderr, only stdout is the basepath
+            extract_fn=lambda rc, stdout, stderr: {'basepath': stdout.strip()},
+            descriptionDone=['cowbuilder layer', ]
+        )
+    )
     # Make and run tests in a cowbuilder
     f.addStep(
         TestBuild(
             name=job_name+'-build',
-            command=['sudo', 'cowbuilder', '--execute',
+            command=['cowbuilder-run.py', distro, arch,
+                     'sudo', 'cowbuilder', '--execute',
                      Interpolate('%(prop:workdir)s/testbuild.py'),
                      '--distribution', distro, '--architecture', arch,
-                     '--bindmounts', binddir, '--basepath',
-                     '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow',
+                     '--bindmounts', bindmounts, '--basepath',
+                     Interpolate('%(prop:basepath)s'),
                      '--override-config', '--othermirror', othermirror,
-                     '--', binddir, rosdistro],
-            logfiles={'tests' : binddir+'/testresults'},
+                     '--'] + testbuild_args,
+            logfiles={'tests' : binddir+'/testresults',
+                      'results' : binddir+'/testresults.json'},
             descriptionDone=['make and test', job_name]
         )
     )
+    # Publish the ccache statistics of the build
+    f.addStep(
+        CcacheStats(
+            stats=binddir+'/ccache.json'
+        )
+    )
     c['builders'].append(
         BuilderConfig(
             name=project_name,
@@ -155,15 +225,38 @@ def ros_testbuild(c, job_name, url, branch, distro, arch, rosdistro, machines,
     # return the name of the job created
     return project_name
 
-## @brief ShellCommand w/overloaded evaluateCommand so that tests can be Warn
+## @brief ShellCommand w/overloaded evaluateCommand so that tests can be Warn.
+##        The per-test results (testresults.json, see testbuild.py) are published as
+##        properties, along with the slowest tests.
 class TestBuild(ShellCommand):
     warnOnWarnings = True
+    slowest = 10
 
     def evaluateCommand(self, cmd):
         if cmd.didFail():
             # build failed
             return results.FAILURE
 
+        tests = self.getTestResults()
+        if tests:
+            totals = tests['totals']
+            failed = totals.get('failure', 0) + totals.get('error', 0)
+            self.setProperty('tests_passed', totals.get('pass', 0), 'TestBuild')
+            self.setProperty('tests_failed', failed, 'TestBuild')
+            self.setProperty('tests_skipped', totals.get('skipped', 0), 'TestBuild')
+            slowest = sorted(tests['tests'], key=lambda t: t['duration'], reverse=True)[:self.slowest]
+            self.setProperty('tests_slowest', [[t['package'], t['name'], t['duration']] for t in slowest], 'TestBuild')
+            if tests.get('parallel'):
+                self.setProperty('tests_jobs', tests['parallel']['jobs'], 'TestBuild')
+            self.addCompleteLog('slowest tests',
+                ''.join(['%8.2fs  %s: %s\n' % (t['duration'], t['package'], t['name']) for t in slowest]))
+            self.descriptionDone = self.descriptionDone + ['%d/%d passed' % (totals.get('pass', 0), totals.get('pass', 0) + failed)]
+            if failed > 0:
+                # some tests failed
+                return results.WARNINGS
+            return results.SUCCESS
+
+        # no XML results, go by the summary of the test output
         l = self.getLog('tests').readlines()
         if len(l) >= 1:
             if l[0].find('Passed') > -1:
@@ -171,3 +264,13 @@ class TestBuild(ShellCommand):
             else:
                 # some tests failed
                 return results.WARNINGS
+
+    ## @brief Get the per-test results, or None if there are none
+    def getTestResults(self):
+        try:
+            tests = json.loads(self.getLog('results').getText())
+        except (KeyError, ValueError):
+            return None
+        if not tests.get('tests'):
+            return None
+        return tests
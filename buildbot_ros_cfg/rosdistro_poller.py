@@ -0,0 +1,100 @@
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from buildbot.changes import base
+
+from rosdistro import get_index, get_release_file, get_source_file, get_doc_file
+
+from buildbot_ros_cfg.distro import distribution_hash, distribution_jobs
+
+## @brief Watches a rosdistro index and its distribution files. When they change, the
+##        jobs which were added, removed or modified are logged and the master is
+##        reconfigured. Reconfiguring only replaces the builders whose configuration
+##        actually changed, so in-flight builds of other jobs are not interrupted, and
+##        the RosDistroOracle cache means only changed distributions are recomputed.
+##        (Buildbot can only reconfigure from the whole master.cfg.)
+class RosDistroPoller(base.PollingChangeSource):
+
+    compare_attrs = ['index_url', 'pollInterval', 'pollAtLaunch']
+
+    ## @brief Constructor
+    ## @param index_url URL of the rosdistro index.yaml
+    ## @param oracle The RosDistroOracle the current configuration was built from
+    ## @param pollInterval How often to check the rosdistro, in seconds
+    def __init__(self, index_url, oracle, pollInterval = 10*60, pollAtLaunch = False):
+        base.PollingChangeSource.__init__(self, name = 'rosdistro_'+index_url,
+                                          pollInterval = pollInterval,
+                                          pollAtLaunch = pollAtLaunch)
+        self.index_url = index_url
+        # a new instance is made on every reconfig and then thrown away, as it compares
+        # equal to the running one, so nothing is computed until the service starts
+        self.oracle = oracle
+        self.hashes = None
+        self.jobs = None
+
+    def startService(self):
+        # the oracle already loaded the files, hashing them needs no HTTP
+        self.hashes = dict()
+        self.jobs = dict()
+        for dist_name in self.oracle.distro_names:
+            files = [self.oracle.getDistributionFile(build, dist_name) for build in ['release', 'source', 'doc']]
+            self.hashes[dist_name] = distribution_hash(files)
+            self.jobs[dist_name] = distribution_jobs(*files)
+        self.oracle = None
+        return base.PollingChangeSource.startService(self)
+
+    def describe(self):
+        return 'RosDistroPoller watching ' + self.index_url
+
+    @defer.inlineCallbacks
+    def poll(self):
+        # loading the rosdistro blocks on HTTP, keep that off the reactor
+        changes, hashes, jobs = yield threads.deferToThread(self._get_changes)
+        if not changes:
+            return
+        for change in changes:
+            log.msg('rosdistro_poller: %s' % change)
+        log.msg('rosdistro_poller: reconfiguring for %d changed jobs' % len(changes))
+        # reconfig logs its own errors, the configuration is only replaced when it loads
+        config = self.master.config
+        yield self.master.reconfig()
+        if self.master.config is config:
+            log.msg('rosdistro_poller: reconfig did not happen, will try again at the next poll')
+            return
+        # this instance survives the reconfig, so remember what we have seen
+        self.hashes = hashes
+        self.jobs = jobs
+
+    ## @brief Compare the rosdistro against the one we were configured with
+    ## @returns A tuple of (list of human readable changes, new hashes, new jobs)
+    def _get_changes(self):
+        index = get_index(self.index_url)
+        changes = list()
+        hashes = dict(self.hashes)
+        jobs = dict(self.jobs)
+        for dist_name in sorted(set(self.hashes.keys()) | set(index.distributions.keys())):
+            if dist_name not in index.distributions:
+                changes.append('removed distribution %s' % dist_name)
+                del hashes[dist_name]
+                del jobs[dist_name]
+                continue
+            files = [get_release_file(index, dist_name),
+                     get_source_file(index, dist_name),
+                     get_doc_file(index, dist_name)]
+            new_hash = distribution_hash(files)
+            if new_hash == self.hashes.get(dist_name):
+                continue
+            new_jobs = distribution_jobs(*files)
+            if dist_name not in self.hashes:
+                changes.append('added distribution %s' % dist_name)
+            old_jobs = self.jobs.get(dist_name, dict())
+            hashes[dist_name] = new_hash
+            jobs[dist_name] = new_jobs
+            for job in sorted(set(old_jobs.keys()) | set(new_jobs.keys())):
+                if job not in new_jobs:
+                    changes.append('removed %s job %s' % (dist_name, job))
+                elif job not in old_jobs:
+                    changes.append('added %s job %s' % (dist_name, job))
+                elif old_jobs[job] != new_jobs[job]:
+                    changes.append('modified %s job %s (%s -> %s)' % (dist_name, job, old_jobs[job], new_jobs[job]))
+        return changes, hashes, jobs
@@ -55,9 +55,15 @@ done
 
 reprepro -V -b $REPO_DIR export
 
+# Clients read immutable snapshots of the indices, through the 'current' symlink
+mkdir -p ${REPO_DIR}/snapshots/0
+cp -al ${REPO_DIR}/dists ${REPO_DIR}/snapshots/0/dists
+ln -s ../../pool ${REPO_DIR}/snapshots/0/pool
+ln -s snapshots/0 ${REPO_DIR}/current
+
 # Notify
 echo ""
 echo "APT Repository has been set up in ${REPO_DIR}"
 echo "Please use scripts/reprepro-include.bash to add a package"
-echo "You may also want to add a symlink in your apache repo to ${REPO_DIR}"
+echo "You may also want to add a symlink in your apache repo to ${REPO_DIR}/current"
 echo ""
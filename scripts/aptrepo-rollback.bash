@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# This script will point the 'building' APT repository at an older snapshot.
+#  The reprepro database is not changed, the next include publishes it again.
+
+export REPO_DIR="/var/www/building/ubuntu"
+
+if [[ ${#} -lt 1 ]]; then
+    echo "Usage: ${0} <snapshot>"
+    echo ""
+    echo "Current snapshot: `readlink ${REPO_DIR}/current`"
+    echo "Available snapshots: `ls ${REPO_DIR}/snapshots | sort -n | tr '\n' ' '`"
+    exit -1
+fi
+export SNAPSHOT=${1}
+
+if [ ! -d "${REPO_DIR}/snapshots/${SNAPSHOT}" ]; then
+    echo "ERROR: snapshot ${SNAPSHOT} does not exist"
+    exit -1
+fi
+
+# rename is atomic, clients never see a missing repository
+ln -s snapshots/${SNAPSHOT} ${REPO_DIR}/current.new
+mv -T ${REPO_DIR}/current.new ${REPO_DIR}/current
+echo "Published snapshot ${SNAPSHOT}"
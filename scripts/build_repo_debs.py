@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# This builds binary debs from source debs inside a cowbuilder session. All of the
+# packages of a repository can be built in one session, rather than creating a
+# new chroot for each package. Each freshly built deb is added to a local APT
+# repository, so that later packages can install it as a build dependency.
+
+from __future__ import print_function
+import sys, os, glob, shutil, subprocess
+from email.utils import formatdate
+
+## @brief Build a list of source packages, in order
+## @param workdir A bind-mounted directory containing the .dsc files, the
+##        binary debs are written here as well.
+## @param version The version to stamp the changelog with
+## @param distro The Ubuntu distro being built for (for instance, 'trusty')
+## @param dscs List of .dsc file names (relative to workdir), in build order
+## @param ccache Directory of the ccache (typically bind-mounted), or None
+## @param ccache_size Maximum size of the ccache
+def run_batch(workdir, version, distro, dscs, ccache=None, ccache_size='5G'):
+    localrepo = os.path.join(workdir, 'localrepo')
+    srcdir = os.path.join(workdir, 'src')
+    for d in [localrepo, srcdir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    # Set up a local repository holding what we build, and the tools we need
+    open(os.path.join(localrepo, 'Packages'), 'w').close()
+    with open('/etc/apt/sources.list.d/buildbot-localrepo.list', 'w') as f:
+        f.write('deb [trusted=yes] file:%s ./\n' % localrepo)
+    call(['apt-get', 'update'])
+    call(['apt-get', 'install', '--yes', '--no-install-recommends', 'devscripts', 'equivs', 'dpkg-dev'] +
+         (['ccache', ] if ccache else []))
+    if ccache:
+        # downloaded by the master next to the source debs (see ccache_helpers.py)
+        sys.path.insert(0, workdir)
+        from ccache_helpers import setup_ccache, write_ccache_stats
+        before = setup_ccache(ccache, ccache_size, workdir)
+
+    for dsc in dscs:
+        package = os.path.basename(dsc).split('_')[0]
+        print('Building %s' % package)
+        pkgdir = os.path.join(srcdir, package)
+        call(['dpkg-source', '-x', os.path.join(workdir, dsc), pkgdir])
+        stamp_changelog(pkgdir, version, distro)
+        call(['mk-build-deps', '--install', '--remove',
+              '--tool', 'apt-get --yes --no-install-recommends',
+              os.path.join(pkgdir, 'debian', 'control')], cwd = pkgdir)
+        call(['dpkg-buildpackage', '-b', '-uc', '-us'], cwd = pkgdir)
+
+        # Move the debs where buildbot expects them, and make them available to the next package
+        for deb in glob.glob(os.path.join(srcdir, '*.deb')):
+            shutil.copy(deb, localrepo)
+            shutil.move(deb, os.path.join(workdir, os.path.basename(deb)))
+        update_localrepo(localrepo)
+        call(['apt-get', 'update',
+              '-o', 'Dir::Etc::sourcelist=sources.list.d/buildbot-localrepo.list',
+              '-o', 'Dir::Etc::sourceparts=-',
+              '-o', 'APT::Get::List-Cleanup=0'])
+
+    if ccache:
+        write_ccache_stats(os.path.join(workdir, 'ccache.json'), before)
+
+## @brief Add a changelog entry for the version we are building, in a similar
+##        fashion to the ROS buildfarm. The maintainer of the latest entry is kept.
+def stamp_changelog(pkgdir, version, distro):
+    changelog = os.path.join(pkgdir, 'debian', 'changelog')
+    with open(changelog) as f:
+        old = f.read()
+    source = old.split(' ', 1)[0]
+    maintainer = 'buildbot <buildbot@localhost>'
+    for line in old.splitlines():
+        if line.startswith(' -- '):
+            maintainer = line[4:].split('  ')[0]
+            break
+    with open(changelog, 'w') as f:
+        f.write('%s (%s) %s; urgency=low\n\n' % (source, version, distro))
+        f.write('  * Automated build by buildbot-ros\n\n')
+        f.write(' -- %s  %s\n\n' % (maintainer, formatdate(localtime = True)))
+        f.write(old)
+    print('Stamped %s with version %s' % (source, version))
+
+## @brief Regenerate the Packages file of the local repository
+def update_localrepo(localrepo):
+    with open(os.path.join(localrepo, 'Packages'), 'w') as f:
+        if subprocess.call(['dpkg-scanpackages', '.', '/dev/null'], cwd = localrepo, stdout = f) != 0:
+            raise BuildException('Failed to update local repository %s' % localrepo)
+
+## @brief Call a command
+## @param command Should be a list
+def call(command, cwd=None):
+    print('Executing command "%s"' % ' '.join(command))
+    helper = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, cwd=cwd)
+    while True:
+        output = helper.stdout.readline().decode('utf8', 'replace')
+        if helper.returncode is not None or not output:
+            break
+        sys.stdout.write(output)
+
+    helper.wait()
+    if helper.returncode != 0:
+        msg = 'Failed to execute command "%s" with return code %d' % (command, helper.returncode)
+        print('/!\  %s' % msg)
+        raise BuildException(msg)
+
+class BuildException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return 'BuildException: %s' % self.msg
+
+if __name__=="__main__":
+    ccache = None
+    ccache_size = '5G'
+    args = list()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--ccache='):
+            ccache = arg[len('--ccache='):]
+        elif arg.startswith('--ccache-size='):
+            ccache_size = arg[len('--ccache-size='):]
+        else:
+            args.append(arg)
+    if len(args) < 4:
+        print('')
+        print('Usage: build_repo_debs.py [--ccache=<dir>] [--ccache-size=<size>] <workdir> <version> <distro> <dsc> [<dsc> ...]')
+        print('')
+        exit(-1)
+    try:
+        run_batch(args[0], args[1], args[2], args[3:], ccache, ccache_size)
+    finally:
+        # Hack so the buildbot can delete this directory later
+        subprocess.call(['chmod', '-R', '777', args[0]])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# This sets up ccache for the builds in a cowbuilder (build_repo_debs.py and testbuild.py),
+# and records the hits and misses of each build for buildbot to publish (see CcacheStats).
+# cowbuilder --execute only copies the script it runs into the chroot, so the master
+# downloads this next to the workspace of the build, which those scripts add to their path.
+
+from __future__ import print_function
+import os, subprocess, re, json
+
+## @brief Compile through ccache (the compilers are found through the PATH, which the
+##        build commands inherit)
+## @param ccache Directory of the ccache (typically bind-mounted)
+## @param size Maximum size of the ccache, past it the least recently used objects are evicted
+## @param basedir Paths below this are hashed as relative paths, so the cache is
+##        shared by builds in different directories
+## @returns The statistics before the build
+def setup_ccache(ccache, size, basedir):
+    os.environ['CCACHE_DIR'] = ccache
+    # the cache is shared with builds running as other users
+    os.environ['CCACHE_UMASK'] = '000'
+    os.environ['CCACHE_BASEDIR'] = basedir
+    os.environ['PATH'] = '/usr/lib/ccache:'+os.environ['PATH']
+    # a cache over its size only costs disk space, not worth failing the build for
+    if subprocess.call(['ccache', '-M', size]) != 0:
+        print('/!\  Failed to set the size of the ccache %s' % ccache)
+    return ccache_stats()
+
+## @brief Get the statistics of ccache
+def ccache_stats():
+    stats = dict()
+    output = subprocess.Popen(['ccache', '-s'], stdout=subprocess.PIPE).communicate()[0].decode('utf8')
+    for line in output.splitlines():
+        parts = re.split(r'\s{2,}', line.strip(), 1)
+        if len(parts) == 2:
+            stats[parts[0]] = parts[1]
+    return stats
+
+## @brief Add the hits and misses since some statistics to a stats file. A build may
+##        run several cowbuilder sessions, each adds to the file; it is removed along
+##        with the results of the last build.
+## @param filename The stats file (ccache.json)
+## @param before The statistics returned by setup_ccache
+def write_ccache_stats(filename, before):
+    after = ccache_stats()
+    def count(stats, key):
+        try:
+            return int(stats.get(key, 0))
+        except ValueError:
+            return 0
+    result = {'hits': 0, 'misses': 0}
+    if os.path.exists(filename):
+        try:
+            with open(filename) as f:
+                result.update(json.load(f))
+        except ValueError:
+            pass
+    for name, keys in [('hits', ['cache hit (direct)', 'cache hit (preprocessed)']), ('misses', ['cache miss'])]:
+        result[name] += sum([count(after, key) - count(before, key) for key in keys])
+    result['size'] = after.get('cache size')
+    result['max_size'] = after.get('max cache size')
+    with open(filename, 'w') as f:
+        json.dump(result, f)
+    print('ccache: %d hits, %d misses, %s of %s used' % (result['hits'], result['misses'], result['size'], result['max_size']))
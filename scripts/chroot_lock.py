@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# This provides the lock protecting a base cowbuilder. Updates take it exclusively, while
+# builds using the base take it shared, so builds run concurrently with each other but
+# never during an update. The kernel releases the lock when the holder dies.
+
+from __future__ import print_function
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+## @brief Returns the path of the lock file of a cowbuilder
+## @param distro The UBUNTU distribution (for instance, 'precise')
+## @param arch The architecture (for instance, 'amd64')
+def lockfile(distro, arch):
+    return '/tmp/buildbot_'+distro+'_'+arch+'.lock'
+
+## @brief Returns the path of the lock file of a cowbuilder layer (see cowbuilder-layer.py)
+## @param path The basepath of the layer
+def layer_lockfile(path):
+    return '/tmp/buildbot_layer_'+os.path.basename(path)+'.lock'
+
+## @brief Hold the lock of a cowbuilder for the duration of a with block
+## @param distro The UBUNTU distribution (for instance, 'precise')
+## @param arch The architecture (for instance, 'amd64')
+## @param shared Take the lock shared (for builds) rather than exclusive (for updates)
+def chroot_lock(distro, arch, shared = False):
+    return _flock(lockfile(distro, arch), '%s-%s cowbuilder' % (distro, arch), shared)
+
+## @brief Hold the lock of a cowbuilder layer for the duration of a with block
+## @param path The basepath of the layer
+## @param shared Take the lock shared (for builds) rather than exclusive (for creation and eviction)
+## @param blocking If False, raise IOError rather than waiting for the lock
+def layer_lock(path, shared = False, blocking = True):
+    return _flock(layer_lockfile(path), 'layer '+os.path.basename(path), shared, blocking)
+
+@contextmanager
+def _flock(path, what, shared, blocking = True):
+    kind = 'shared' if shared else 'exclusive'
+    start = time.time()
+    print('Getting %s lock on %s' % (kind, what))
+    with open(path, 'a') as f:
+        fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        print('Got %s lock on %s after waiting %.1f seconds' % (kind, what, time.time() - start))
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
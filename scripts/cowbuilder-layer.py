@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# This prepares a cowbuilder layer for a testbuild: a copy of the base cowbuilder with the
+# build and test dependencies of a workspace already installed. The run dependencies are
+# left to the testbuild, which installs them after building, so that a run dependency
+# standing in for a missing build dependency still breaks the build. Layers are keyed by
+# a hash of the build and test dependencies found in the package.xml files, so a testbuild
+# whose dependencies have not changed starts from a populated chroot. The least recently
+# used layers are evicted to stay within a disk budget.
+#
+# The basepath to build with is the only thing printed to stdout, everything else goes to
+# stderr. If a layer cannot be made, the base cowbuilder is printed.
+
+from __future__ import print_function
+import sys
+import os
+import subprocess
+import time
+import hashlib
+import json
+from xml.etree import ElementTree
+
+from testbuild import call
+from chroot_lock import chroot_lock, layer_lock
+
+LAYER_DIR = '/var/cache/pbuilder/layers'
+# the dependencies testbuild.py installs before building
+DEPEND_TAGS = ['build_depend', 'buildtool_depend', 'test_depend', 'depend']
+
+## @brief Returns the basepath of the cowbuilder (see cowbuilder-update.py)
+def basepath(distro, arch):
+    return '/var/cache/pbuilder/base-'+distro+'-'+arch+'.cow'
+
+## @brief Returns the path of the metadata of a layer
+def metafile(path):
+    return os.path.join(os.path.expanduser('~'), '.buildbot-ros', 'layers', os.path.basename(path)+'.json')
+
+def read_meta(path):
+    try:
+        with open(metafile(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_meta(path, meta):
+    if not os.path.exists(os.path.dirname(metafile(path))):
+        os.makedirs(os.path.dirname(metafile(path)))
+    # builds sharing a layer update its metadata at the same time, each writes its own file
+    tmp = '%s.%d' % (metafile(path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp, metafile(path))
+
+## @brief Get the dependencies of the packages in a workspace, other than the packages themselves
+def workspace_depends(workspace):
+    names = set()
+    depends = set()
+    for root, dirs, files in os.walk(os.path.join(workspace, 'src')):
+        if 'CATKIN_IGNORE' in files:
+            del dirs[:]
+            continue
+        if 'package.xml' in files:
+            # packages do not nest
+            del dirs[:]
+            xml = ElementTree.parse(os.path.join(root, 'package.xml')).getroot()
+            names.add(xml.findtext('name').strip())
+            for tag in DEPEND_TAGS:
+                depends |= set([d.text.strip() for d in xml.findall(tag)])
+    return sorted(depends - names)
+
+## @brief Hash of everything that ends up in a layer
+def layer_key(distro, arch, rosdistro, othermirror, depends):
+    # the base cowbuilder's keys and mirrors (see cowbuilder-update.py)
+    try:
+        with open(os.path.join(os.path.expanduser('~'), '.buildbot-ros', 'cowbuilder-'+distro+'-'+arch+'.json')) as f:
+            base = json.load(f).get('config')
+    except (IOError, ValueError):
+        base = None
+    key = [distro, arch, rosdistro, othermirror, base, depends]
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+## @brief Size of a directory in bytes
+def disk_usage(path):
+    with open(os.devnull, 'w') as devnull:
+        du = subprocess.Popen(['du', '-sb', path], stdout=subprocess.PIPE, stderr=devnull)
+        output = du.communicate()[0].decode('utf8')
+    try:
+        return int(output.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+## @brief Get a layer for a workspace, making it if needed
+## @returns The basepath of the layer
+## @param cache Directory shared between builds, passed on to testbuild.py, or None
+def get_layer(distro, arch, rosdistro, workspace, script, othermirror, budget, max_age, cache = None):
+    depends = workspace_depends(workspace)
+    path = os.path.join(LAYER_DIR, '%s-%s-%s.cow' % (distro, arch, layer_key(distro, arch, rosdistro, othermirror, depends)[:16]))
+    if use_layer(path, max_age):
+        return path
+    with layer_lock(path):
+        # somebody might have made it while we waited
+        if use_layer(path, max_age):
+            return path
+        print('Making layer %s with: %s' % (path, ', '.join(depends)))
+        start = time.time()
+        call(['sudo', 'rm', '-rf', path, path+'.tmp'])
+        call(['sudo', 'mkdir', '-p', LAYER_DIR])
+        with chroot_lock(distro, arch, shared = True):
+            call(['sudo', 'cp', '-a', basepath(distro, arch), path+'.tmp'])
+        bindmounts = workspace
+        testbuild_args = [workspace, rosdistro, '--deps-only']
+        if cache:
+            bindmounts += ' '+cache
+            testbuild_args.append('--cache='+cache)
+        call(['sudo', 'cowbuilder', '--execute', script, '--save-after-exec',
+              '--distribution', distro, '--architecture', arch,
+              '--bindmounts', bindmounts, '--basepath', path+'.tmp',
+              '--override-config', '--othermirror', othermirror,
+              '--'] + testbuild_args)
+        call(['sudo', 'mv', path+'.tmp', path])
+        now = time.time()
+        write_meta(path, {'created': now, 'used': now, 'size': disk_usage(path), 'depends': depends})
+        print('Made layer %s in %.1f seconds' % (path, now - start))
+    evict(budget, path)
+    return path
+
+## @brief Mark a layer as used, if it exists and is not too old
+def use_layer(path, max_age):
+    meta = read_meta(path)
+    if meta == None or not os.path.exists(path):
+        return False
+    if time.time() - meta['created'] > max_age:
+        print('Layer %s is too old' % path)
+        return False
+    meta['used'] = time.time()
+    write_meta(path, meta)
+    print('Using layer %s' % path)
+    return True
+
+## @brief Remove the least recently used layers until they fit in the budget
+## @param keep A layer to never remove
+## @param idle Layers used more recently than this (in seconds) are left alone, as a build
+##        may be about to use them
+def evict(budget, keep, idle = 30*60):
+    layers = list()
+    metadir = os.path.dirname(metafile(keep))
+    for name in os.listdir(metadir):
+        if not name.endswith('.cow.json'):
+            continue
+        path = os.path.join(LAYER_DIR, name[:-len('.json')])
+        meta = read_meta(path)
+        if meta != None:
+            layers.append((meta['used'], path, meta['size']))
+    total = sum([size for used, path, size in layers])
+    print('Layers use %.1f of %.1f GB' % (total/1e9, budget/1e9))
+    for used, path, size in sorted(layers):
+        if total <= budget:
+            break
+        if path == keep or time.time() - used < idle:
+            continue
+        try:
+            with layer_lock(path, blocking = False):
+                print('Evicting layer %s' % path)
+                call(['sudo', 'rm', '-rf', path])
+                os.remove(metafile(path))
+                total -= size
+        except IOError:
+            print('Layer %s is in use, not evicting' % path)
+
+if __name__=="__main__":
+    budget = 20
+    max_age = 24
+    cache = None
+    args = list()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--cache='):
+            cache = arg[len('--cache='):]
+        elif arg.startswith('--budget='):
+            budget = float(arg[len('--budget='):])
+        elif arg.startswith('--max-age='):
+            max_age = float(arg[len('--max-age='):])
+        else:
+            args.append(arg)
+    if len(args) < 6:
+        print('')
+        print('Usage: cowbuilder-layer.py [--budget=<GB>] [--max-age=<hours>] [--cache=<dir>] <distro> <arch> <rosdistro> <workspace> <testbuild.py> <othermirror>')
+        print('')
+        exit(-1)
+    distro, arch = args[0], args[1]
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        path = get_layer(distro, arch, args[2], args[3], args[4], args[5], budget*1e9, max_age*60*60, cache)
+    except Exception as e:
+        print('Unable to use a layer, building in the base cowbuilder: %s' % e)
+        path = basepath(distro, arch)
+    stdout.write(path+'\n')
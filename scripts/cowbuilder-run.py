@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+# This runs a command using a base cowbuilder (for instance, 'sudo cowbuilder --execute ...'),
+# holding the cowbuilder lock shared, so that it is not updated underneath the command. If the
+# command uses a layer (see cowbuilder-layer.py) as its --basepath, the layer is locked instead.
+
+from __future__ import print_function
+import sys
+import subprocess
+
+from chroot_lock import chroot_lock, layer_lock
+
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print('')
+        print('Usage: cowbuilder-run.py <distro> <arch> <command> [<args> ...]')
+        print('')
+        exit(-1)
+    command = sys.argv[3:]
+    if '--basepath' in command and '/layers/' in command[command.index('--basepath')+1]:
+        lock = layer_lock(command[command.index('--basepath')+1], shared = True)
+    else:
+        lock = chroot_lock(sys.argv[1], sys.argv[2], shared = True)
+    with lock:
+        sys.stdout.flush()
+        returncode = subprocess.call(command)
+    exit(returncode)
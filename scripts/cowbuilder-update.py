@@ -1,59 +1,28 @@
 #!/usr/bin/env python
 
-# This is used to setup the cowbuilder
+# This is used to setup the cowbuilder. A stamp is kept for each cowbuilder in
+# ~/.buildbot-ros, so that it is only updated when the TTL has expired and the
+# Ubuntu archive actually changed, or when the keys and mirrors change.
 
 from __future__ import print_function
 import sys
 import os
 import subprocess
 import time
+import hashlib
+import json
+import base64
+import shutil
+import tempfile
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
 
 # A bit hacky, but do this rather than redefine the function.
 # Has to be in testbuild, as we only copy testbuild to pbuilder.
 from testbuild import call
-
-import random
-file_num = random.randrange(100000)
-
-## @brief Returns whether we could lock the file
-def get_lock(distro, arch):
-    global file_num
-    if os.path.isfile('/tmp/buildbot_'+distro+'_'+arch+'_lock'):
-        # check if our file_num is in the file
-        try:
-            with open('/tmp/buildbot_'+distro+'_'+arch+'_lock') as f:
-                value = int(f.read().rstrip())
-                if value == file_num:
-                    return True
-                else:
-                    # somebody already has a lock
-                    return False
-        except:
-            return False
-    else:
-        # try to put our file_num in the lock file:
-        with open('/tmp/buildbot_'+distro+'_'+arch+'_lock', 'w') as f:
-            f.write(str(file_num))
-        # wait a moment
-        time.sleep(0.05)
-        # check that we got the lock
-        return get_lock(distro, arch)
-
-def release_lock(distro, arch):
-    if os.path.isfile('/tmp/buildbot_'+distro+'_'+arch+'_lock'):
-        # check if our file_num is in the file
-        try:
-            with open('/tmp/buildbot_'+distro+'_'+arch+'_lock') as f:
-                value = int(f.read().rstrip())
-                if value == file_num:
-                    os.remove('/tmp/buildbot_'+distro+'_'+arch+'_lock')
-                    return True
-                else:
-                    # somebody already has a lock
-                    return False
-        except:
-            return False
-    return False
+from chroot_lock import chroot_lock
 
 ## @brief Returns the basepath of the cowbuilder
 ## @param distro The UBUNTU distribution (for instance, 'precise')
@@ -70,20 +39,149 @@ def defaultmirrors(distro, arch):
         # use ubuntu ports for other cowbuilders (such as arm)
         return "deb http://ports.ubuntu.com/ubuntu-ports DISTRO main universe".replace('DISTRO', distro)
 
+## @brief Seconds after an update during which the cowbuilder is not checked at all
+DEFAULT_TTL = 60*60
+
+## @brief Returns the path of the freshness stamp of a cowbuilder
+def stampfile(distro, arch):
+    return os.path.join(os.path.expanduser('~'), '.buildbot-ros', 'cowbuilder-'+distro+'-'+arch+'.json')
+
+def read_stamp(distro, arch):
+    try:
+        with open(stampfile(distro, arch)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+def write_stamp(distro, arch, stamp):
+    path = stampfile(distro, arch)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # several builds may update at once, each writes its own file
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(stamp, f)
+    os.rename(tmp, path)
+
+## @brief Hash of everything that is put in the cowbuilder, other than packages
+## @param fingerprints Fingerprints of the keys in the cowbuilder
+def config_hash(distro, arch, fingerprints):
+    config = [basepath(distro, arch), defaultmirrors(distro, arch), sorted(fingerprints)]
+    return hashlib.sha256(json.dumps(config).encode('utf-8')).hexdigest()
+
+## @brief Hash of the Release file of the Ubuntu archive, None if it cannot be fetched
+def release_hash(distro, arch):
+    url = defaultmirrors(distro, arch).split()[1]+'/dists/'+distro+'/Release'
+    try:
+        return hashlib.sha256(urlopen(url, timeout = 30).read()).hexdigest()
+    except Exception as e:
+        print('Unable to fetch %s: %s' % (url, e))
+        return None
+
+## @brief Decide how much work the cowbuilder needs
+## @returns A tuple of 'fresh', 'update' or 'full', and the hash of the Release file
+def needed_update(distro, arch, fingerprints, ttl):
+    stamp = read_stamp(distro, arch)
+    if not os.path.exists(basepath(distro, arch)) or stamp.get('config') != config_hash(distro, arch, fingerprints):
+        print('cowbuilder for %s-%s is new or its keys/mirrors changed' % (distro, arch))
+        return 'full', None
+    age = time.time() - stamp.get('checked', 0)
+    if age < ttl:
+        print('cowbuilder for %s-%s was checked %d seconds ago, not updating' % (distro, arch, age))
+        return 'fresh', stamp.get('release')
+    release = release_hash(distro, arch)
+    if release != None and release == stamp.get('release'):
+        print('Ubuntu archive for %s has not changed, not updating' % distro)
+        stamp['checked'] = time.time()
+        write_stamp(distro, arch, stamp)
+        return 'fresh', release
+    return 'update', release
+
+## @brief Returns the directory keys are cached in
+def keydir():
+    return os.path.join(os.path.expanduser('~'), '.buildbot-ros', 'keys')
+
+## @brief Get the fingerprints of the keys in an armored or binary key file
+def key_fingerprints(path):
+    home = tempfile.mkdtemp()
+    try:
+        output = subprocess.check_output(['gpg', '--homedir', home, '--with-colons', '--with-fingerprint', path],
+                                         stderr = subprocess.STDOUT).decode('utf8', 'replace')
+    finally:
+        shutil.rmtree(home)
+    return sorted(set([line.split(':')[9] for line in output.splitlines() if line.startswith('fpr:')]))
+
+## @brief Get keys, only downloading the ones which are not cached yet, or were last
+##        checked more than ttl seconds ago (a key may be rotated at the same URL)
+## @param keys List of key URLs
+## @param ttl Seconds during which a cached key is used without checking its URL
+## @returns A list of (fingerprints, key data)
+def fetch_keys(keys, ttl = DEFAULT_TTL):
+    if not os.path.exists(keydir()):
+        os.makedirs(keydir())
+    index_path = os.path.join(keydir(), 'index.json')
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = dict()
+    result = list()
+    for key in keys:
+        path = os.path.join(keydir(), hashlib.sha256(key.encode('utf-8')).hexdigest()+'.key')
+        entry = index.get(key)
+        # entries of older versions are a plain list of fingerprints, check those again
+        cached = isinstance(entry, dict) and os.path.exists(path)
+        if not cached or time.time() - entry.get('checked', 0) >= ttl:
+            print('Downloading key %s' % key)
+            try:
+                data = urlopen(key, timeout = 30).read()
+            except Exception as e:
+                if not cached:
+                    raise
+                print('Failed to download key %s (%s), using the cached copy' % (key, e))
+                data = None
+            if data != None:
+                old = None
+                if cached:
+                    with open(path, 'rb') as f:
+                        old = f.read()
+                if data == old:
+                    entry['checked'] = time.time()
+                else:
+                    tmp = '%s.%d' % (path, os.getpid())
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                    fingerprints = key_fingerprints(tmp)
+                    if not fingerprints:
+                        os.remove(tmp)
+                        raise Exception('No key found at %s' % key)
+                    if cached and fingerprints != entry['fingerprints']:
+                        print('Key %s changed: %s' % (key, ', '.join(fingerprints)))
+                    os.rename(tmp, path)
+                    entry = {'fingerprints': fingerprints, 'checked': time.time()}
+                index[key] = entry
+        with open(path, 'rb') as f:
+            result.append((index[key]['fingerprints'], f.read()))
+    tmp = '%s.%d' % (index_path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp, index_path)
+    return result
+
+## @brief Get the commands adding keys inside the cowbuilder, so nothing is downloaded in there
+## @param keys List of (fingerprints, key data), as returned by fetch_keys
 def getKeyCommands(keys):
     if len(keys) == 0:
         return ""
-    return '\n'.join(['wget '+key+' -O- | apt-key add -' for key in keys])+'\n'
+    return '\n'.join(['echo '+base64.b64encode(data).decode('ascii')+' | base64 -d | apt-key add -'
+                      for fingerprints, data in keys])+'\n'
 
 ## @brief Make a cowbuilder, if one does not exist
 ## @param distro The UBUNTU distribution (for instance, 'precise')
 ## @param arch The architecture (for instance, 'amd64')
-## @param keys List of keys to get
-def make_cowbuilder(distro, arch, keys):
-    print('(' + str(time.time()) +')Getting lock on cowbuilder')
-    while not get_lock(distro, arch):
-        time.sleep(1.0)
-    print('(' + str(time.time()) +')Got lock!')
+## @param keys List of (fingerprints, key data), as returned by fetch_keys
+## @param full If False, only update the packages, the keys and mirrors are unchanged
+def make_cowbuilder(distro, arch, keys, full = True):
     if not os.path.exists(basepath(distro, arch)):
         # create the cowbuilder
         call(['sudo', 'cowbuilder', '--create',
@@ -96,7 +194,19 @@ def make_cowbuilder(distro, arch, keys):
     else:
         print('cowbuilder already exists for %s-%s' % (distro, arch))
 
-    # login and install wget (for later adding keys)
+    if full:
+        login_cowbuilder(distro, arch, keys)
+
+    # update
+    print('updating cowbuilder')
+    call(['sudo', 'cowbuilder', '--update',
+          '--distribution', distro,
+          '--architecture', arch,
+          '--basepath', basepath(distro, arch)])
+
+## @brief Install what later steps need in the cowbuilder, and add the keys
+def login_cowbuilder(distro, arch, keys):
+    # login, install python (for the build scripts) and add the keys
     command = ['sudo', 'cowbuilder', '--login',
                '--save-after-login',
                '--distribution', distro,
@@ -107,8 +217,6 @@ def make_cowbuilder(distro, arch, keys):
     cowbuilder = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
     output = cowbuilder.communicate(input="""echo "Installing python"
 apt-get install python -y
-echo "Installing wget"
-apt-get install wget -y
 """+getKeyCommands(keys)+"""echo "exiting"
 exit
 """)
@@ -116,25 +224,41 @@ exit
     if cowbuilder.returncode != 0:
         exit(cowbuilder.returncode)
 
-    # update
-    print('updating cowbuilder')
-    call(['sudo', 'cowbuilder', '--update',
-          '--distribution', distro,
-          '--architecture', arch,
-          '--basepath', basepath(distro, arch)])
+## @brief Bring a cowbuilder up to date, if it needs to be
+## @param ttl Seconds after an update during which the cowbuilder is not checked
+def update_cowbuilder(distro, arch, keys, ttl = DEFAULT_TTL):
+    # the chroot only needs to change when the set of fingerprints does
+    keys = fetch_keys(keys, ttl)
+    fingerprints = set([fpr for fprs, data in keys for fpr in fprs])
+    print('Using %d keys: %s' % (len(fingerprints), ', '.join(sorted(fingerprints))))
+    # checking does not need the lock, so concurrent builds are not blocked when fresh
+    action, release = needed_update(distro, arch, fingerprints, ttl)
+    if action == 'fresh':
+        return
+    with chroot_lock(distro, arch):
+        # somebody else might have updated while we waited for the lock
+        stamp = read_stamp(distro, arch)
+        if stamp.get('config') == config_hash(distro, arch, fingerprints) and time.time() - stamp.get('checked', 0) < ttl:
+            print('cowbuilder for %s-%s was updated while waiting for the lock' % (distro, arch))
+            return
+        make_cowbuilder(distro, arch, keys, full = (action == 'full'))
+        if release == None:
+            release = release_hash(distro, arch)
+        write_stamp(distro, arch, {'checked': time.time(),
+                                   'config': config_hash(distro, arch, fingerprints),
+                                   'release': release})
 
 if __name__=="__main__":
-    if len(sys.argv) < 3:
+    ttl = DEFAULT_TTL
+    args = list()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--ttl='):
+            ttl = int(arg[len('--ttl='):])
+        else:
+            args.append(arg)
+    if len(args) < 2:
         print('')
-        print('Usage: cowbuilder.py <distro> <arch>')
+        print('Usage: cowbuilder-update.py [--ttl=<seconds>] <distro> <arch> [<key> ...]')
         print('')
         exit(-1)
-    distro = sys.argv[1]
-    arch = sys.argv[2]
-    try:
-        if len(sys.argv) > 3:
-            make_cowbuilder(distro, arch, sys.argv[3:])
-        else:
-            make_cowbuilder(distro, arch, [])
-    finally:
-        release_lock(distro, arch)
+    update_cowbuilder(args[0], args[1], args[2:], ttl)
@@ -17,11 +17,20 @@ export DISTRO=${3}
 export ARCH=${4}
 
 # invalidate dependent
-reprepro -V -b $REPO_DIR removefilter $DISTRO "Package (% * ), Architecture (==$ARCH), (Depends (% *$PKG[, ]* ) | Depends (% *$PKG ) )"
+reprepro -V -b $REPO_DIR --keepunreferencedfiles removefilter $DISTRO "Package (% * ), Architecture (==$ARCH), (Depends (% *$PKG[, ]* ) | Depends (% *$PKG ) )"
 
 # invalidate this package
-reprepro -V -b $REPO_DIR removefilter $DISTRO "Package (==$PKG), Architecture (==$ARCH)"
-
-reprepro -V -b $REPO_DIR deleteunreferenced
-
-reprepro -V -b $REPO_DIR includedeb $DISTRO $BUILD_DIR/binarydebs/$NAME
+reprepro -V -b $REPO_DIR --keepunreferencedfiles removefilter $DISTRO "Package (==$PKG), Architecture (==$ARCH)"
+
+# unreferenced files are deleted by the master, once no snapshot uses them
+reprepro -V -b $REPO_DIR --keepunreferencedfiles includedeb $DISTRO $BUILD_DIR/binarydebs/$NAME
+
+# publish a snapshot of the indices, see buildbot_ros_cfg/apt_repo.py
+SERIAL=`ls $REPO_DIR/snapshots | grep -E '^[0-9]+$' | sort -n | tail -n 1`
+SERIAL=$((${SERIAL:--1} + 1))
+mkdir -p $REPO_DIR/snapshots/.$SERIAL
+cp -al $REPO_DIR/dists $REPO_DIR/snapshots/.$SERIAL/dists
+ln -s ../../pool $REPO_DIR/snapshots/.$SERIAL/pool
+mv $REPO_DIR/snapshots/.$SERIAL $REPO_DIR/snapshots/$SERIAL
+ln -s snapshots/$SERIAL $REPO_DIR/current.new
+mv -T $REPO_DIR/current.new $REPO_DIR/current
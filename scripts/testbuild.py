@@ -3,7 +3,8 @@
 # This file is the actual buildtest that is run
 
 from __future__ import print_function
-import sys, os, subprocess, shutil
+import sys, os, subprocess, shutil, time, json, hashlib, io, re, multiprocessing, fcntl, tempfile
+from xml.etree import ElementTree
 
 GTESTPASS = '[       OK ]'
 GTESTFAIL = '[  FAILED  ]'
@@ -18,15 +19,31 @@ ROSTESTERROR = ' * ERRORS: '
 ## @param workspace Directory to do work in (typically bind-mounted,
 ##        code needs to be already checked out to workspace/src/*)
 ## @param rosdistro Name of the distro to build for, for instance, 'groovy'
-def run_build_and_test(workspace, rosdistro):
+## @param deps_only Only install the build and test dependencies, used to prepare a
+##        cowbuilder layer (the run dependencies are installed by each build)
+## @param cache Directory shared between builds (typically bind-mounted), or None
+## @param jobs Number of parallel jobs to build and test with, None to detect
+## @param incremental Branch being built, to keep the build tree of (in the cache) for
+##        the next build, or None to build from scratch
+## @param budget Disk space in bytes for the build trees and workspaces kept in the cache
+## @param ccache Directory of the ccache (typically bind-mounted), or None
+## @param ccache_size Maximum size of the ccache
+def run_build_and_test(workspace, rosdistro, deps_only=False, cache=None, jobs=None,
+                       incremental=None, budget=10e9, ccache=None, ccache_size='5G'):
+
+    timer = PhaseTimer()
+    if deps_only:
+        ccache = None
 
     # need to install dependencies, hack python path, import stuff
     call(['apt-get', 'update'])
-    apt_get_install(['python-rosdistro', 'python-catkin-pkg'])
+    apt_get_install(['python-rosdistro', 'python-catkin-pkg', 'lsb-release', 'python-rosdep'] +
+                    (['ccache', ] if ccache else []))
     if not os.path.abspath("/usr/lib/pymodules/python2.7") in sys.path:
         sys.path.append("/usr/lib/pymodules/python2.7")
     from rosdistro import get_index, get_index_url, get_source_file
     from catkin_pkg import packages
+    timer.done('bootstrap')
 
     # Find packages to build
     print('Searching for something yummy to build...')
@@ -37,142 +54,481 @@ def run_build_and_test(workspace, rosdistro):
     else:
         raise BuildException('No packages to build or test.')
 
-    # Get build + test dependencies
-    print('Examining build dependencies.')
-    build_depends = []
-    for pkg in pkgs.values():
-        for d in pkg.build_depends + pkg.buildtool_depends + pkg.test_depends:
-            if not d.name in build_depends and not d.name in building:
-                build_depends.append(d.name)
-    print('Installing: %s' % ', '.join(build_depends))
-    rosdep = RosDepResolver(rosdistro)
-    apt_get_install(rosdep.to_aptlist(build_depends))
-    pip_install(rosdep.to_piplist(build_depends))
+    # Work out everything to install, in one pass
+    rosdep = RosDepResolver(rosdistro, cache)
+    timer.done('rosdep')
+    plan = InstallPlan(rosdep, pkgs.values(), set(building))
+    plan.show()
+    timer.done('plan')
+
+    if deps_only:
+        plan.install_build()
+        timer.done('install')
+        timer.show()
+        return
+
+    # Only the build and test dependencies are installed for the build,
+    # so that missing build dependencies are still caught
+    plan.install_build()
+    timer.done('install build depends')
+
+    # Compile through ccache
+    if ccache:
+        # downloaded by the master into the workspace (see ccache_helpers.py)
+        sys.path.insert(0, workspace)
+        from ccache_helpers import setup_ccache, write_ccache_stats
+        ccache_before = setup_ccache(ccache, ccache_size, workspace)
 
     # Get environment
     ros_env = get_ros_env('/opt/ros/%s/setup.bash' % rosdistro)
 
-    os.makedirs(workspace+'/build')
+    if incremental and cache:
+        builddir = os.path.join(cache, 'builds', build_key(workspace, incremental))
+        # held until we exit, so the workspace and tree are not evicted or used by another build
+        workspace_lock = lock_build(os.path.normpath(workspace))
+        lock = lock_build(builddir)
+        prepare_build(builddir, build_stamp(rosdistro, plan))
+        timer.done('prepare build tree')
+    else:
+        builddir = workspace+'/build'
+        os.makedirs(builddir)
     if os.path.exists(workspace+'/test'):
         shutil.rmtree(workspace+'/test')
     os.makedirs(workspace+'/test')
-    os.chdir(workspace+'/build')
+    os.chdir(builddir)
 
-    print('catkin_init_workspace')
-    call(['catkin_init_workspace', '../src'], ros_env)
+    if not os.path.exists(workspace+'/src/CMakeLists.txt'):
+        print('catkin_init_workspace')
+        call(['catkin_init_workspace', workspace+'/src'], ros_env)
     # Workaround for nosetest 1.3.1 issue with non-absolute paths on Trusty
     #  (https://github.com/nose-devs/nose/issues/779)
-    test_dir = os.path.realpath('../test')
-    call(['cmake', '../src', '-DCATKIN_TEST_RESULTS_DIR='+test_dir], ros_env)
+    test_dir = os.path.realpath(workspace+'/test')
+    call(['cmake', workspace+'/src', '-DCATKIN_TEST_RESULTS_DIR='+test_dir], ros_env)
     
-    print('make')
-    call(['make'], ros_env)
+    jobs = jobs or detect_jobs()
+    print('make with %d jobs' % jobs)
+    call(['make', '-j%d' % jobs], ros_env)
     print('make tests')
-    call(['make', 'tests'], ros_env)
+    call(['make', '-j%d' % jobs, 'tests'], ros_env)
+    if ccache:
+        write_ccache_stats(workspace + '/ccache.json', ccache_before)
+    timer.done('build')
 
     # now install the run depends
-    print('Examining run dependencies.')
-    run_depends = []
-    for pkg in pkgs.values():
-        for d in pkg.run_depends:
-            if not d.name in run_depends and not d.name in building:
-                run_depends.append(d.name)
-    print('Installing: %s' % ', '.join(run_depends))
-    apt_get_install(rosdep.to_aptlist(run_depends))
-    pip_install(rosdep.to_piplist(run_depends))
-
-    # Run the tests
+    plan.install_run()
+    timer.done('install run depends')
+
+    # Run the tests, parsing the output as it arrives and keeping the raw log on disk
     print('make run_tests')
     ros_env = get_ros_env('./devel/setup.bash')
-    test_results = call(['make', 'run_tests'], ros_env, return_output = True)
-
-    # Output test results to a file
-    f = open(workspace + '/testresults', 'w')
-
-    # Metrics from tests
-    gtest_pass = list()
-    gtest_fail = list()
-    pnose_fail = list()
-    pnose_total = 0 # can only count these?
-    rostest_pass = 0
-    rostest_fail = 0
-    rostest_err = 0
+    parallel, serial = test_targets(ros_env, building)
+    parser = TestOutputParser(workspace + '/testresults.raw')
+    try:
+        if parallel or serial:
+            if parallel:
+                print('Running %d tests with %d jobs' % (len(parallel), jobs))
+                call(['make', '-j%d' % jobs] + parallel, ros_env, handler = parser.feed)
+            if serial:
+                print('Running %d tests one at a time' % len(serial))
+                call(['make'] + serial, ros_env, handler = parser.feed)
+        else:
+            call(['make', 'run_tests'], ros_env, handler = parser.feed)
+    finally:
+        parser.close()
+    timer.done('run tests')
+
+    # Output test results to a file, and the per-test results catkin wrote
+    results = read_junit_results(test_dir)
+    write_json_results(workspace + '/testresults.json', results,
+                       {'jobs': jobs, 'parallel_tests': len(parallel), 'serial_tests': len(serial)})
+    parser.write_results(workspace + '/testresults', results)
 
-    for line in test_results.split('\n'):
+    # Hack so the buildbot can delete this later
+    call(['chmod', '777', workspace+'/testresults', workspace+'/testresults.json'] +
+         ([workspace+'/ccache.json', ] if ccache else []))
+    cleanup()
+    if incremental and cache:
+        evict_builds(cache, budget, [builddir, os.path.normpath(workspace)])
+    timer.show()
+
+## @brief Name of the build tree of a workspace and branch
+def build_key(workspace, branch):
+    return os.path.basename(os.path.normpath(workspace))+'_'+re.sub('[^A-Za-z0-9._-]', '_', branch)
+
+## @brief Take the lock of a build tree or workspace
+## @param blocking If False, raise IOError if the lock is taken. Otherwise the directory
+##        is about to be used, which is recorded for the eviction
+## @returns The lock file, which holds the lock until closed
+def lock_build(builddir, blocking=True):
+    if not os.path.exists(os.path.dirname(builddir)):
+        os.makedirs(os.path.dirname(builddir))
+    f = open(builddir+'.lock', 'a')
+    try:
+        if blocking:
+            print('Waiting for the lock on %s' % builddir)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # for the eviction of the least recently used trees
+            os.utime(builddir+'.lock', None)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        raise
+    return f
+
+## @brief Hash of everything a build tree depends on besides the sources: the installed
+##        packages (the dependencies and the toolchain) and the dependencies declared
+def build_stamp(rosdistro, plan):
+    installed = subprocess.Popen(['dpkg-query', '-W', '-f', '${Package} ${Version}\n'],
+                                 stdout=subprocess.PIPE).communicate()[0]
+    sha = hashlib.sha256()
+    sha.update(rosdistro.encode('utf-8'))
+    sha.update(installed)
+    sha.update(' '.join(sorted(plan.build_depends)).encode('utf-8'))
+    return sha.hexdigest()
+
+## @brief Reuse a build tree if it was built against the same stamp, otherwise start
+##        it over
+## @returns True if the tree is reused
+def prepare_build(builddir, stamp):
+    stampfile = os.path.join(builddir, '.buildbot-stamp')
+    try:
+        with open(stampfile) as f:
+            if f.read() == stamp:
+                print('Reusing build tree %s' % builddir)
+                return True
+        print('Dependencies or toolchain changed, building %s from scratch' % builddir)
+    except IOError:
+        print('No build tree to reuse, building %s from scratch' % builddir)
+    if os.path.exists(builddir):
+        shutil.rmtree(builddir)
+    os.makedirs(builddir)
+    with open(stampfile, 'w') as f:
+        f.write(stamp)
+    return False
+
+## @brief Remove the least recently used build trees and workspaces (the checkouts of the
+##        incremental testbuilds) until they fit in the budget. A removed workspace is
+##        checked out again by its next build.
+## @param cache The cache directory, with the builds/ and workspaces/ directories
+## @param keep Build trees and workspaces to never remove
+def evict_builds(cache, budget, keep):
+    trees = list()
+    total = 0
+    for kind in ['builds', 'workspaces']:
+        parent = os.path.join(cache, kind)
+        if not os.path.isdir(parent):
+            continue
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if not os.path.isdir(path):
+                continue
+            size = disk_usage(path)
+            total += size
+            try:
+                used = os.path.getmtime(path+'.lock')
+            except OSError:
+                used = 0
+            trees.append((used, path, size))
+    print('Build trees and workspaces use %.1f of %.1f GB' % (total/1e9, budget/1e9))
+    for used, path, size in sorted(trees):
+        if total <= budget:
+            break
+        if path in keep:
+            continue
+        try:
+            lock = lock_build(path, blocking=False)
+        except IOError:
+            print('%s is in use, not evicting' % path)
+            continue
+        print('Evicting %s' % path)
+        shutil.rmtree(path, ignore_errors=True)
+        lock.close()
+        total -= size
+
+## @brief Size of a directory in bytes
+def disk_usage(path):
+    du = subprocess.Popen(['du', '-sb', path], stdout=subprocess.PIPE)
+    output = du.communicate()[0].decode('utf8')
+    try:
+        return int(output.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+## @brief Parses the output of the tests line by line, counting the gtest, nose and rostest
+##        results. The raw output is written to a file as it arrives, rather than kept in memory.
+class TestOutputParser:
+    MARKERS = [GTESTPASS, GTESTFAIL, PNOSEFAIL, PNOSECONFIGFAIL, PNOSEEXCEPTION, 'Ran ',
+               ROSTESTPASS, ROSTESTFAIL, ROSTESTERROR]
+
+    ## @param raw File to write the raw output to
+    def __init__(self, raw):
+        self.raw = raw
+        self.log = io.open(raw, 'w', encoding='utf-8')
+        # most lines match none of the markers, one search rules them out
+        self.match = re.compile('|'.join([re.escape(m) for m in self.MARKERS])).search
+        self.gtest_pass = list()
+        self.gtest_fail = list()
+        self.pnose_fail = list()
+        self.pnose_total = 0 # can only count these?
+        self.rostest_pass = 0
+        self.rostest_fail = 0
+        self.rostest_err = 0
+
+    ## @brief Parse one line of output
+    def feed(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf8', 'replace')
+        self.log.write(line)
+        if not self.match(line):
+            return
+        line = line.rstrip('\n')
         # Is this a gtest pass?
         if line.find(GTESTPASS) > -1:
             name = line[line.find(GTESTPASS)+len(GTESTPASS)+1:].split(' ')[0]
-            gtest_pass.append(name)
+            self.gtest_pass.append(name)
         # How about a gtest fail?
         if line.find(GTESTFAIL) > -1:
             name = line[line.find(GTESTFAIL)+len(GTESTPASS)+1:].split(' ')[0]
-            gtest_fail.append(name)
+            self.gtest_fail.append(name)
         # pnose fail?
         if line.find(PNOSEFAIL) > -1:
             name = line.split(' ')[2].rstrip()
-            pnose_fail.append(name)
+            self.pnose_fail.append(name)
         # pnose failed to configure? (issue #17)
         if line.find(PNOSECONFIGFAIL) > -1:
-            pnose_fail.append('python configure')
+            self.pnose_fail.append('python configure')
         # pnose exception?
         if line.find(PNOSEEXCEPTION) > -1:
-            pnose_fail.append('python exception')
+            self.pnose_fail.append('python exception')
         # is this our total for python?
         if line.find('Ran ') > -1:
-            pnose_total += int(line.split(' ')[1])
+            self.pnose_total += int(line.split(' ')[1])
         # Is this a rostest pass?
         if line.find(ROSTESTPASS) > -1:
-            rostest_pass += int(line[line.find(ROSTESTPASS)+len(ROSTESTPASS):].split(' ')[0])
+            self.rostest_pass += int(line[line.find(ROSTESTPASS)+len(ROSTESTPASS):].split(' ')[0])
         # Is this a rostest fail?
         if line.find(ROSTESTFAIL) > -1:
-            l = line[line.find(ROSTESTFAIL)+len(ROSTESTFAIL):]
-            while len(l) > 0:
-                try:
-                    rostest_fail += int(l.split(' ')[0])
-                    break
-                except ValueError:
-                    # Might have formatting attached, remove 1 character at time
-                    l = l[0:-1]
+            self.rostest_fail += self.count(line[line.find(ROSTESTFAIL)+len(ROSTESTFAIL):])
         # Is this a rostest error?
         if line.find(ROSTESTERROR) > -1:
-            l = line[line.find(ROSTESTERROR)+len(ROSTESTERROR):]
-            while len(l) > 0:
+            self.rostest_err += self.count(line[line.find(ROSTESTERROR)+len(ROSTESTERROR):])
+
+    ## @brief Get the count at the start of a rostest summary line
+    def count(self, l):
+        while len(l) > 0:
+            try:
+                return int(l.split(' ')[0])
+            except ValueError:
+                # Might have formatting attached, remove 1 character at time
+                l = l[0:-1]
+        return 0
+
+    def close(self):
+        self.log.close()
+
+    def passed(self):
+        return len(self.gtest_pass) + self.pnose_total - len(self.pnose_fail) + self.rostest_pass
+
+    def failed(self):
+        return len(self.gtest_fail) + len(self.pnose_fail) + self.rostest_fail + self.rostest_err
+
+    ## @brief Write the summary followed by the raw output, which is then removed
+    ## @param results Per-test results (see read_junit_results), used for the summary
+    ##        instead of the counts from the output when there are any
+    def write_results(self, filename, results=None):
+        if results:
+            failures = [t['package']+': '+t['name'] for t in results if t['status'] in ['failure', 'error']]
+            passed = len([t for t in results if t['status'] == 'pass'])
+            failed = len(failures)
+        else:
+            failures = self.gtest_fail + self.pnose_fail
+            passed = self.passed()
+            failed = self.failed()
+        summary = ''
+        if failed > 0:
+            summary += '*'*70 + '\n'
+            summary += 'Failed '+str(failed)+' of '+str(passed+failed)+' tests.\n'
+            for test in failures:
+                summary += '  failed: '+test+'\n'
+            summary += 'See details below\n'
+            summary += '*'*70 + '\n'
+        else:
+            summary += 'Passed '+str(passed)+' tests.\n'
+        summary += '\n'
+        with open(filename, 'wb') as f:
+            f.write(summary.encode('utf-8'))
+            with open(self.raw, 'rb') as raw:
+                shutil.copyfileobj(raw, f, 1024*1024)
+        os.remove(self.raw)
+
+## @brief Read the JUnit XML files catkin writes to the test results directory
+##        (one directory per package), in the same way as catkin_test_results.
+## @returns A list of tests, each a dict with name, package, status ('pass',
+##          'failure', 'error' or 'skipped') and duration in seconds
+def read_junit_results(test_dir):
+    results = list()
+    for root, dirs, files in os.walk(test_dir):
+        dirs.sort()
+        package = os.path.relpath(root, test_dir).split(os.sep)[0]
+        for name in sorted(files):
+            if not name.endswith('.xml'):
+                continue
+            try:
+                tree = ElementTree.parse(os.path.join(root, name))
+            except Exception as e:
+                # unreadable results count as an error, like catkin_test_results does
+                print('Unable to parse test results %s: %s' % (name, e))
+                results.append({'name': name, 'package': package, 'status': 'error', 'duration': 0.0})
+                continue
+            for case in tree.getroot().iter('testcase'):
+                status = 'pass'
+                for tag in ['skipped', 'error', 'failure']:
+                    if case.find(tag) is not None:
+                        status = tag
+                if case.get('classname'):
+                    test = case.get('classname')+'.'+case.get('name', '')
+                else:
+                    test = case.get('name', '')
                 try:
-                    rostest_err += int(l.split(' ')[0])
-                    break
+                    duration = float(case.get('time', 0))
                 except ValueError:
-                    # Might have formatting attached, remove 1 character at time
-                    l = l[0:-1]
-
-
-    # determine if we failed
-    passed = len(gtest_pass) + pnose_total - len(pnose_fail) + rostest_pass
-    failed = len(gtest_fail) + len(pnose_fail) + rostest_fail + rostest_err
-    if failed > 0:
-        f.write('*'*70 + '\n')
-        f.write('Failed '+str(failed)+' of '+str(passed+failed)+' tests.\n')
-        for test in gtest_fail + pnose_fail:
-            f.write('  failed: '+test+'\n')
-        f.write('See details below\n')
-        f.write('*'*70 + '\n')
-    else:
-        f.write('Passed '+str(passed)+' tests.\n')
-
-    f.write('\n')
-    f.write(test_results)
-    f.close()
-
-    # Hack so the buildbot can delete this later
-    call(['chmod', '777', workspace+'/testresults'])
-    cleanup()
+                    duration = 0.0
+                results.append({'name': test, 'package': package, 'status': status, 'duration': duration})
+    return results
+
+## @brief Write the per-test results, with the totals, as compact JSON
+## @param parallel How the tests were run (see run_build_and_test)
+def write_json_results(filename, results, parallel=None):
+    totals = dict()
+    for status in ['pass', 'failure', 'error', 'skipped']:
+        totals[status] = len([t for t in results if t['status'] == status])
+    with open(filename, 'w') as f:
+        json.dump({'totals': totals, 'tests': results, 'parallel': parallel}, f, separators=(',', ':'))
+    print('Found %d tests in the XML results: %s' % (len(results), ', '.join(['%d %s' % (totals[s], s) for s in sorted(totals)])))
+
+## @brief Number of parallel jobs for this machine: one per core, as long as each has
+##        enough memory (compiling ROS C++ code easily takes more than a GB per job)
+## @param job_memory Memory needed per job, in bytes
+def detect_jobs(job_memory=2*1024*1024*1024):
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    jobs = cpus
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    jobs = min(cpus, int(line.split()[1])*1024 // job_memory)
+    except (IOError, ValueError, IndexError):
+        pass
+    jobs = max(1, jobs)
+    print('Detected %d cores, using %d jobs' % (cpus, jobs))
+    return jobs
+
+## @brief Split the tests of the packages being built into those that can safely run
+##        concurrently (gtest and nose, which do not share anything), and the others.
+##        rostests (and any other kind of test) each start a ROS master on the same
+##        port, so these are run one at a time.
+## @returns The parallel and the serial catkin test targets, both empty if the targets
+##          could not be found (then the run_tests target should be used)
+def test_targets(ros_env, building):
+    parallel = list()
+    serial = list()
+    # not call(), a BuildException would clean up the workspace
+    helper = subprocess.Popen(['make', 'help'], stdout=subprocess.PIPE, env=ros_env)
+    targets = helper.communicate()[0].decode('utf8', 'replace')
+    if helper.returncode != 0:
+        return parallel, serial
+    # longest first, package names can contain underscores
+    prefixes = ['run_tests_'+name+'_' for name in sorted(building, key=len, reverse=True)]
+    for line in targets.splitlines():
+        if not line.startswith('... run_tests_'):
+            continue
+        target = line[4:].split()[0]
+        for prefix in prefixes:
+            if target.startswith(prefix):
+                kind, _, test = target[len(prefix):].partition('_')
+                # run_tests_<package>_<kind> runs all tests of that kind, skip it
+                if test:
+                    if kind in ['gtest', 'nosetests']:
+                        parallel.append(target)
+                    else:
+                        serial.append(target)
+                break
+    return parallel, serial
+
+## @brief Everything which needs to be installed for a build, worked out in a single pass
+##        over the packages and installed in as few apt and pip transactions as possible
+class InstallPlan:
+    ## @param rosdep A RosDepResolver
+    ## @param pkgs The catkin packages being built
+    ## @param building Set of the names of the packages being built
+    def __init__(self, rosdep, pkgs, building):
+        build_depends = set()
+        run_depends = set()
+        for pkg in pkgs:
+            build_depends |= set([d.name for d in pkg.build_depends + pkg.buildtool_depends + pkg.test_depends])
+            run_depends |= set([d.name for d in pkg.run_depends])
+        build_depends -= building
+        run_depends -= building
+        self.build_apt = rosdep.to_aptlist(build_depends)
+        self.build_pip = rosdep.to_piplist(build_depends)
+        # whatever the build already installed is left out
+        self.run_apt = rosdep.to_aptlist(run_depends) - self.build_apt
+        self.run_pip = rosdep.to_piplist(run_depends) - self.build_pip
+        self.build_depends = build_depends
+        self.run_depends = run_depends
+
+    def show(self):
+        print('Install plan:')
+        print('  build depends: %s' % ', '.join(sorted(self.build_depends)))
+        print('  run depends: %s' % ', '.join(sorted(self.run_depends)))
+        print('  apt for build: %s' % ', '.join(sorted(self.build_apt)))
+        print('  pip for build: %s' % ', '.join(sorted(self.build_pip)))
+        print('  apt for run: %s' % ', '.join(sorted(self.run_apt)))
+        print('  pip for run: %s' % ', '.join(sorted(self.run_pip)))
+
+    def install_build(self):
+        self.install(self.build_apt, self.build_pip)
+
+    def install_run(self):
+        self.install(self.run_apt, self.run_pip)
+
+    ## @brief One apt transaction (with pip, if needed) and one pip transaction
+    def install(self, apt, pip):
+        if pip:
+            apt = apt | set(['python-pip'])
+        apt_get_install(sorted(apt))
+        pip_install(sorted(pip))
+
+## @brief Keeps track of the time spent in each phase of a build
+class PhaseTimer:
+    def __init__(self):
+        self.phases = list()
+        self.last = time.time()
+
+    ## @brief Mark the end of a phase, which started when the last one ended
+    def done(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        print('Phase "%s" took %.1f seconds' % (name, now - self.last))
+        self.last = now
+
+    def show(self):
+        print('Time spent in each phase:')
+        for name, elapsed in self.phases:
+            print('  %-24s %8.1f seconds' % (name, elapsed))
 
 ## @brief Call a command
 ## @param command Should be a list
-def call(command, envir=None, verbose=True, return_output=False):
+## @param handler Called with each line of output, as it arrives
+def call(command, envir=None, verbose=True, return_output=False, handler=None):
     print('Executing command "%s"' % ' '.join(command))
     helper = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, env=envir)
     if return_output:
-        res = ''
+        res = list()
     while True:
         output = helper.stdout.readline().decode('utf8', 'replace')
         if helper.returncode is not None or not output:
@@ -184,7 +540,9 @@ def call(command, envir=None, verbose=True, return_output=False):
                 output = "lost some output, unable to encode in utf-8"
                 sys.stdout.write(output)
         if return_output:
-            res += output
+            res.append(output)
+        if handler:
+            handler(output)
 
     helper.wait()
     if helper.returncode != 0:
@@ -192,7 +550,7 @@ def call(command, envir=None, verbose=True, return_output=False):
         print('/!\  %s' % msg)
         raise BuildException(msg)
     if return_output:
-        return res
+        return ''.join(res)
 
 ## @brief imported from jenkins-scripts/common.py
 def get_ros_env(setup_file):
@@ -222,10 +580,8 @@ def apt_get_install(pkgs, sudo=False):
     else:
         print('Not installing anything from apt right now.')
 
-## @brief install pip dependencies
+## @brief install pip dependencies, python-pip has to be installed already
 def pip_install(pkgs, sudo=False):
-    # Make sure we have pip
-    apt_get_install(['python-pip'], sudo=sudo)
     cmd = ["pip", "install"]
     if sudo:
         cmd = ["sudo", ] + cmd
@@ -237,18 +593,36 @@ def pip_install(pkgs, sudo=False):
 
 ## @brief from jenkins-scripts/rosdep.py
 class RosDepResolver:
-    def __init__(self, rosdistro):
+    ## @param cache Directory to cache the rosdep database in, or None
+    ## @param ttl Seconds before a cached database is updated
+    def __init__(self, rosdistro, cache=None, ttl=24*60*60):
         self.r2a = {}
         self.env = os.environ
         self.env['ROS_DISTRO'] = rosdistro
 
-        # Initialize rosdep database
+        # Initialize rosdep database (lsb-release and python-rosdep have to be installed)
         print('Ininitalize rosdep database')
-        call(['apt-get', 'install', '--yes', 'lsb-release', 'python-rosdep'])
         try:
             call(['rosdep', 'init'], self.env)
         except:
             print('Rosdep is already initialized')
+
+        cache_file = None
+        if cache:
+            cache_file = os.path.join(cache, 'rosdep_'+rosdistro+'.json')
+            sources = self.sources_hash()
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                age = time.time() - cached['time']
+                if age < ttl and cached['sources'] == sources:
+                    print('Using rosdep database cached %d seconds ago' % age)
+                    self.r2a = cached['r2a']
+                    return
+                print('Cached rosdep database is stale')
+            except (IOError, ValueError, KeyError):
+                print('No cached rosdep database')
+
         call(['rosdep', 'update'], self.env)
 
         print('Building dictionarys from a rosdep db')
@@ -262,6 +636,25 @@ class RosDepResolver:
             apt_entries = split_entry[1].split(' ')
             self.r2a[ros_entry] = apt_entries
 
+        if cache_file:
+            # write atomically, other builds may be reading it (or writing it too)
+            fd, tmp = tempfile.mkstemp(dir=cache, prefix='.rosdep_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'time': time.time(), 'sources': sources, 'r2a': self.r2a}, f, separators=(',', ':'))
+            os.chmod(tmp, 0o666)
+            os.rename(tmp, cache_file)
+
+    ## @brief Hash of the rosdep sources lists, the cache is stale when they change
+    def sources_hash(self):
+        sha = hashlib.sha256()
+        sources = '/etc/ros/rosdep/sources.list.d'
+        if os.path.isdir(sources):
+            for name in sorted(os.listdir(sources)):
+                sha.update(name.encode('utf-8'))
+                with open(os.path.join(sources, name), 'rb') as f:
+                    sha.update(f.read())
+        return sha.hexdigest()
+
     def to_apt(self, ros_entry):
         if ros_entry not in self.r2a:
             print('Could not find %s in keys.' % ros_entry)
@@ -269,23 +662,21 @@ class RosDepResolver:
             return ['ros-'+self.env['ROS_DISTRO']+'-'+ros_entry.replace('_','-'),]
         return self.r2a[ros_entry]
 
+    ## @returns Set of the apt packages for some rosdep keys
     def to_aptlist(self, ros_entries):
-        res = []
+        res = set()
         for r in ros_entries:
             if r.endswith("-pip"):
                 continue
-            for a in self.to_apt(r):
-                if not a in res:
-                    res.append(a)
+            res.update(self.to_apt(r))
         return res
 
+    ## @returns Set of the pip packages for some rosdep keys
     def to_piplist(self, ros_entries):
-        res = []
+        res = set()
         for r in ros_entries:
             if r.endswith("-pip"):
-                for a in self.r2a[r]:
-                    if not a in res:
-                        res.append(a)
+                res.update(self.r2a[r])
         return res
 
 class BuildException(Exception):
@@ -310,14 +701,42 @@ def cleanup():
         pass
 
 if __name__=="__main__":
-    if len(sys.argv) < 3:
+    deps_only = '--deps-only' in sys.argv
+    cache = None
+    jobs = None
+    incremental = None
+    budget = 10
+    ccache = None
+    ccache_size = '5G'
+    args = list()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--cache='):
+            cache = arg[len('--cache='):]
+        elif arg.startswith('--jobs='):
+            jobs = int(arg[len('--jobs='):]) or None
+        elif arg.startswith('--incremental='):
+            incremental = arg[len('--incremental='):]
+        elif arg.startswith('--build-budget='):
+            budget = float(arg[len('--build-budget='):])
+        elif arg.startswith('--ccache='):
+            ccache = arg[len('--ccache='):]
+        elif arg.startswith('--ccache-size='):
+            ccache_size = arg[len('--ccache-size='):]
+        elif arg != '--deps-only':
+            args.append(arg)
+    if len(args) < 2:
         print('')
-        print('Usage: testbuild.py <workspace> <rosdistro>')
+        print('Usage: testbuild.py <workspace> <rosdistro> [--deps-only] [--cache=<dir>] [--jobs=<n>]')
+        print('                    [--incremental=<branch> [--build-budget=<GB>]]')
+        print('                    [--ccache=<dir> [--ccache-size=<size>]]')
         print('')
         exit(-1)
-    workspace = sys.argv[1] # for cleanup
+    # for cleanup, the sources are still needed after only installing dependencies,
+    # and kept for the next build when building incrementally
+    workspace = None if deps_only or (incremental and cache) else args[0]
     try:
-        run_build_and_test(sys.argv[1], sys.argv[2])
+        run_build_and_test(args[0], args[1], deps_only, cache, jobs, incremental, budget*1e9,
+                           ccache, ccache_size)
     except Exception as e:
         cleanup()
         raise BuildException(str(e))